@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+import main
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+VALID_BRANDS = ["Galaxy", "POCO", "Redmi", "iPhone", "Redtone", "VOCAL", "TCL", "NOKIA", "Honor", "Huawei", "GLX", "+Otel", "اینچی"]
+
+MODELS = [
+    ("Galaxy", ["A05", "A15", "A25", "A35", "A55", "S23 FE", "S24", "S24 Ultra", "Z Flip5"]),
+    ("Redmi", ["13C", "Note 13", "Note 13 Pro", "A3", "12"]),
+    ("POCO", ["X6 Pro", "M6 Pro", "C65", "F6"]),
+    ("iPhone", ["13 CH", "14 ZA", "15 Pro Max LL", "16 Pro"]),
+    ("NOKIA", ["105", "106", "C32", "G22"]),
+    ("Galaxy", ["Tab A9", "Tab S9 FE"]),
+    ("", ["Nartab T10", "تبلت Lenovo Tab M10"]),
+    ("", ["لپ تاپ Asus Vivobook 15.6 اینچی", "لپ تاپ Lenovo IdeaPad 14 اینچی"]),
+    ("", ["کنسول بازی Play Station 5 Slim", "کنسول بازی Xbox Series S"]),
+]
+STORAGE = ["4/64", "4/128", "6/128", "8/128", "8/256", "12/512", "256GB", "512GB"]
+COLORS = ["مشکی", "سفید", "آبی", "سبز", "طلایی", "نقره‌ای", "بنفش", "آبی روشن", "خاکستری تیره"]
+
+def generate_catalog(line_count, seed=0):
+    # متن‌های صفحه را به همان ترتیبی که extract_product_data برمی‌گرداند می‌سازد: عنوان، سپس (رنگ، قیمت)
+    rng = random.Random(seed)
+    texts = []
+    while len(texts) < line_count:
+        brand, names = rng.choice(MODELS)
+        title = f"{brand} {rng.choice(names)} {rng.choice(STORAGE)}".strip()
+        texts.append(title)
+        for color in rng.sample(COLORS, rng.randint(1, 4)):
+            texts.append(color)
+            texts.append(f"{rng.randint(20, 1200) * 100000:,} تومان")
+    return texts[:line_count]
+
+def run_stages(texts):
+    brands, models = yield "parse", lambda: main.parse_product_texts(texts, VALID_BRANDS)
+    lines = [f"{m} {b}".strip() for b, m in zip(brands, models)]
+    yield "classify", lambda: main.get_category_classifier().classify_many(lines)
+    values = [float(i * 100000) for i in range(len(texts))]
+    yield "price", lambda: main.get_pricing_engine().price_many(values)
+    products = yield "build", lambda: main.build_products(brands, models)
+    categorized = yield "categorize", lambda: main.categorize_products(products)
+    rendered = yield "render", lambda: [main.render_category_blocks(emoji, groups, "") for emoji, groups in categorized.items() if groups]
+    parts = yield "split", lambda: [part for blocks in rendered for part in main.split_blocks(blocks)]
+    yield "escape", lambda: [main.escape_special_characters(part.text) for part in parts]
+
+def warm_up():
+    # بارگذاری تنبل numpy، فایل pricing.json، قواعد دسته‌بندی و persiantools در زمان اولین مرحله حساب نشود
+    main.get_pricing_engine()
+    main.get_category_classifier()
+    main.jalali_today()
+
+def measure(texts, repeat):
+    warm_up()
+    timings = {}
+    stages = run_stages(texts)
+    result = None
+    try:
+        name, func = next(stages)
+        while True:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = func()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            timings[name] = {"seconds": best, "peak_bytes": peak}
+            name, func = stages.send(result)
+    except StopIteration:
+        pass
+    return timings
+
+def mutate_catalog(products, kind, rng):
+    # یک تغییر معمول بین دو اجرا: تغییر یک قیمت، حذف یک مدل یا اضافه شدن یک مدل
+    products = [main.Product(p.brand, p.model, p.category, p.variant, p.raw_price, p.price, p.label, p.group) for p in products]
+    if kind == "price":
+        product = rng.choice([product for product in products if product.price is not None])
+        product.price += rng.choice([-1, 1]) * 500000
+    elif kind == "remove":
+        group = rng.choice(products).group
+        products = [product for product in products if product.group != group]
+    else:
+        group = rng.choice(products).group
+        new_group = max(product.group for product in products) + 1
+        for product in [product for product in products if product.group == group]:
+            products.append(main.Product(product.brand, product.model + " New", product.category, product.variant,
+                                         product.raw_price, product.price, product.label, new_group))
+    return products
+
+def render_catalog(products):
+    return {emoji: main.prepare_final_message(emoji, groups, "") for emoji, groups in main.categorize_products(products).items() if groups}
+
+def measure_part_churn(texts, trials=20, seed=0):
+    # تعداد پارت‌هایی که با یک تغییر ویرایش می‌شوند: تقسیم‌بندی پایدار در برابر تقسیم حریصانه قبلی
+    rng = random.Random(seed)
+    brands, models = main.parse_product_texts(texts, VALID_BRANDS)
+    products = main.build_products(brands, models)
+    before = render_catalog(products)
+    greedy_prev = {emoji: main.split_message_by_emoji_group(message, slack=0) for emoji, message in before.items()}
+    stable_prev = {emoji: main.split_message_by_emoji_group(message) for emoji, message in before.items()}
+    churn = {}
+    for kind in ("price", "remove", "add"):
+        totals = {"greedy": 0, "stable": 0}
+        for _ in range(trials):
+            after = render_catalog(mutate_catalog(products, kind, rng))
+            for emoji, message in after.items():
+                greedy_next = main.split_message_by_emoji_group(message, slack=0)
+                stable_next = main.split_message_by_emoji_group(message, previous_parts=stable_prev.get(emoji))
+                totals["greedy"] += count_changed_parts(greedy_prev.get(emoji, []), greedy_next)
+                totals["stable"] += count_changed_parts(stable_prev.get(emoji, []), stable_next)
+        churn[kind] = {key: value / trials for key, value in totals.items()}
+    return churn
+
+def count_changed_parts(previous, current):
+    changed = sum(1 for i, part in enumerate(current) if i >= len(previous) or previous[i] != part)
+    return changed + max(0, len(previous) - len(current))
+
+def compare(results, baseline, threshold, memory_threshold):
+    regressions = []
+    for size, stages in results.items():
+        for stage, values in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if not base:
+                continue
+            if values["seconds"] > base["seconds"] * (1 + threshold):
+                regressions.append(f"{size}/{stage}: {base['seconds'] * 1000:.1f}ms → {values['seconds'] * 1000:.1f}ms")
+            if "peak_bytes" in base and values["peak_bytes"] > base["peak_bytes"] * (1 + memory_threshold):
+                regressions.append(f"{size}/{stage}: {base['peak_bytes'] / 1024:.0f} KiB → {values['peak_bytes'] / 1024:.0f} KiB")
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="بنچمارک آفلاین مراحل ساخت پیام")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="ذخیره نتایج به عنوان مبنای جدید")
+    parser.add_argument("--threshold", type=float, default=0.25, help="حداکثر کندی مجاز نسبت به مبنا")
+    parser.add_argument("--memory-threshold", type=float, default=0.25, help="حداکثر افزایش مجاز اوج حافظه نسبت به مبنا")
+    parser.add_argument("--churn", action="store_true", help="اندازه‌گیری تعداد پارت‌های ویرایش‌شده پس از یک تغییر معمول در کاتالوگ")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        texts = generate_catalog(size)
+        results[str(size)] = measure(texts, args.repeat)
+        print(f"\n📊 {size} خط")
+        for stage, values in results[str(size)].items():
+            print(f"  {stage:<11} {values['seconds'] * 1000:>10.2f} ms   {values['peak_bytes'] / 1024:>10.0f} KiB")
+        if args.churn:
+            for kind, values in measure_part_churn(texts).items():
+                print(f"  churn/{kind:<6} greedy {values['greedy']:.2f} / stable {values['stable']:.2f} پارت ویرایش‌شده")
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 مبنا در {args.baseline} ذخیره شد.")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold, args.memory_threshold)
+        if regressions:
+            print("\n❌ کندی یا مصرف حافظه بیش از حد مجاز:")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("\n✅ همه مراحل در محدوده مبنا هستند.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,68 +1,375 @@
 #!/usr/bin/env python3
 import os
 import time
-import requests
+MODULE_STARTED = time.perf_counter()
 import logging
 import json
-import pytz
+import abc
 import sys
 import base64
-import gspread
-from pytz import timezone
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime
-from datetime import datetime, time as dt_time
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from persiantools.jdatetime import JalaliDate
+import hashlib
+import bisect
+import re
+import threading
+import sqlite3
+import queue
+import argparse
+import contextlib
+import functools
+import itertools
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone, time as dt_time
 
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 SHEET_NAME = 'Sheet1'
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_TARGETS = os.getenv("TELEGRAM_TARGETS", "")
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "4"))
+SETTLE_QUIET_PERIOD = float(os.getenv("SETTLE_QUIET_PERIOD", "2"))
+CARD_DROP_WARN_RATIO = float(os.getenv("CARD_DROP_WARN_RATIO", "0.8"))
+SETTLE_MAX_WAIT = float(os.getenv("SETTLE_MAX_WAIT", "20"))
+SCRAPER_BACKEND = os.getenv("SCRAPER_BACKEND", "selenium")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "20"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state/messages.db")
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "state/journal.jsonl")
+JOURNAL_SNAPSHOT_MAX_AGE = float(os.getenv("JOURNAL_SNAPSHOT_MAX_AGE", "300"))
+SHEET_MIRROR = os.getenv("SHEET_MIRROR", "1") == "1"
+SHEET_MIRROR_TIMEOUT = float(os.getenv("SHEET_MIRROR_TIMEOUT", "60"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "4"))
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", "4"))
+CATEGORY_FINGERPRINTS = os.getenv("CATEGORY_FINGERPRINTS", "1") == "1"
+TIMESTAMP_REFRESH = os.getenv("TIMESTAMP_REFRESH", "1") == "1"
+MESSAGE_PART_SLACK = int(os.getenv("MESSAGE_PART_SLACK", "400"))
+DAEMON_INTERVAL = float(os.getenv("DAEMON_INTERVAL", "240"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "2"))
+PRICING_CONFIG_PATH = os.getenv("PRICING_CONFIG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing.json"))
+CATEGORY_RULES_PATH = os.getenv("CATEGORY_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_rules.json"))
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "1") == "1"
+BLOCK_STYLESHEETS = os.getenv("BLOCK_STYLESHEETS", "0") == "1"
+RESOURCE_ALLOW_LIST = [pattern for pattern in os.getenv("RESOURCE_ALLOW_LIST", "").split(",") if pattern.strip()]
+BROWSER_PROFILE_DIR = os.path.expanduser(os.getenv("BROWSER_PROFILE_DIR", "~/.cache/hamrahtel/chrome"))
+BROWSER_CACHE_SIZE = int(os.getenv("BROWSER_CACHE_SIZE", str(64 * 1024 * 1024)))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+RUN_REPORT_DIR = os.getenv("RUN_REPORT_DIR", "reports")
+TOKEN_CACHE_DIR = os.path.expanduser(os.getenv("TOKEN_CACHE_DIR", "~/.cache/hamrahtel"))
+TOKEN_EXPIRY_MARGIN = float(os.getenv("TOKEN_EXPIRY_MARGIN", "300"))
+PRICE_HISTORY_DB = os.getenv("PRICE_HISTORY_DB", "state/price_history.db")
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-iran_tz = pytz.timezone('Asia/Tehran')
-now = datetime.now(iran_tz)
-current_time = now.time()
-start_time = dt_time(9, 30)
-end_time = dt_time(23, 30)
-if not (start_time <= current_time <= end_time):
-    print("🕒 خارج از بازه مجاز اجرا (۹:۳۰ تا ۲۳:۳۰). اسکریپت متوقف شد.")
-    sys.exit()
+CATEGORY_EMOJIS = ('🔵', '🟡', '🍏', '🟣', '💻', '🟠', '🎮')
 
-def get_driver():
+RUN_WINDOW_START = dt_time(9, 30)
+RUN_WINDOW_END = dt_time(23, 30)
+# ایران از سال ۱۴۰۲ ساعت تابستانی ندارد؛ با اختلاف ثابت نیازی به بارگذاری pytz نیست
+TEHRAN_TZ = dt_timezone(timedelta(hours=3, minutes=30))
+
+def within_run_window():
+    current_time = datetime.now(TEHRAN_TZ).time()
+    return RUN_WINDOW_START <= current_time <= RUN_WINDOW_END
+
+startup_timings = {}
+
+def lazy_import(name):
+    # ماژول‌های سنگین (selenium، gspread، numpy، bs4، requests و ...) فقط در اولین استفاده
+    # بارگذاری می‌شوند تا اجرای خارج از بازه و مسیرهایی که به آن‌ها نیازی ندارند هزینه‌اش را نپردازند
+    if name in sys.modules:
+        return importlib.import_module(name)
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    startup_timings.setdefault(f"import.{name}", time.perf_counter() - started)
+    return module
+
+def jalali_today():
+    return lazy_import("persiantools.jdatetime").JalaliDate.today()
+
+def log_startup_timings():
+    # زمان‌های ثبت‌شده از آخرین گزارش (بارگذاری ماژول، importهای تنبل، احراز هویت) در لاگ اجرا
+    timings = [(name, startup_timings.pop(name)) for name in list(startup_timings)]
+    if not timings:
+        return
+    for name, seconds in timings:
+        if metrics.enabled:
+            metrics.record(f"startup.{name}", seconds)
+    logging.info("⏱️ راه‌اندازی: %s", "، ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings))
+
+class Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start, failed=exc_type is not None)
+        return False
+
+NULL_SPAN = contextlib.nullcontext()
+
+class Metrics:
+    # زمان هر مرحله و هر فراخوانی خارجی و شمارنده‌ها (تعداد، بایت، تلاش مجدد) را جمع می‌کند
+    # و در پایان اجرا به صورت JSON و فایل متنی Prometheus می‌نویسد. وقتی غیرفعال است
+    # span یک context manager خالی و مشترک برمی‌گرداند و count بلافاصله برمی‌گردد
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.spans = {}
+            self.counters = {}
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, seconds, failed=False):
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+            stats["count"] += 1
+            stats["errors"] += failed
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, status):
+        with self.lock:
+            return {
+                "started_at": datetime.fromtimestamp(self.started_at, dt_timezone.utc).isoformat(),
+                "duration_seconds": round(time.time() - self.started_at, 3),
+                "status": status,
+                "spans": {name: dict(stats) for name, stats in sorted(self.spans.items())},
+                "counters": dict(sorted(self.counters.items()))
+            }
+
+    @staticmethod
+    def prometheus(report):
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+        lines = [
+            "# TYPE hamrahtel_run_timestamp_seconds gauge",
+            f"hamrahtel_run_timestamp_seconds {datetime.fromisoformat(report['started_at']).timestamp():.0f}",
+            "# TYPE hamrahtel_run_duration_seconds gauge",
+            f"hamrahtel_run_duration_seconds {report['duration_seconds']}",
+            "# TYPE hamrahtel_run_status gauge",
+            f'hamrahtel_run_status{{status="{label(report["status"])}"}} 1'
+        ]
+        for metric, key in (("span_seconds", "seconds"), ("span_max_seconds", "max_seconds"), ("span_calls", "count"), ("span_errors", "errors")):
+            lines.append(f"# TYPE hamrahtel_{metric} gauge")
+            for name, stats in report["spans"].items():
+                lines.append(f'hamrahtel_{metric}{{span="{label(name)}"}} {round(stats[key], 6)}')
+        lines.append("# TYPE hamrahtel_counter gauge")
+        for name, value in report["counters"].items():
+            lines.append(f'hamrahtel_counter{{name="{label(name)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, status):
+        # گزارش آخرین اجرا جایگزین می‌شود و یک خط هم به تاریخچه اجراها اضافه می‌شود
+        if not self.enabled:
+            return None
+        report = self.report(status)
+        os.makedirs(directory, exist_ok=True)
+        for name, content in (("run_report.json", json.dumps(report, ensure_ascii=False, indent=2)),
+                              ("hamrahtel.prom", self.prometheus(report))):
+            path = os.path.join(directory, name)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        with open(os.path.join(directory, "run_reports.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False) + "\n")
+        return report
+
+metrics = Metrics()
+
+# درخواست‌هایی که extract_product_data به آن‌ها نیازی ندارد: تصاویر، ویدیو، فونت و ردیاب‌ها
+BLOCKED_IMAGE_PATTERNS = ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*", "*/_next/image*"]
+BLOCKED_MEDIA_PATTERNS = ["*.mp4*", "*.webm*", "*.mp3*", "*.m3u8*"]
+BLOCKED_FONT_PATTERNS = ["*.woff*", "*.ttf*", "*.otf*", "*.eot*", "*fonts.googleapis.com*", "*fonts.gstatic.com*"]
+BLOCKED_TRACKER_PATTERNS = [
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*facebook.net*",
+    "*hotjar.com*", "*clarity.ms*", "*yektanet.com*", "*najva.com*", "*mediaad.org*",
+    "*goftino.com*", "*raychat.io*", "*trustseal.enamad.ir*"
+]
+BLOCKED_STYLESHEET_PATTERNS = ["*.css*"]
+
+def blocked_url_patterns(block_stylesheets=BLOCK_STYLESHEETS, allow_list=RESOURCE_ALLOW_LIST):
+    # setBlockedURLs استثنا نمی‌پذیرد؛ الگوهای allow-list از فهرست مسدودها حذف می‌شوند
+    patterns = BLOCKED_IMAGE_PATTERNS + BLOCKED_MEDIA_PATTERNS + BLOCKED_FONT_PATTERNS + BLOCKED_TRACKER_PATTERNS
+    if block_stylesheets:
+        patterns = patterns + BLOCKED_STYLESHEET_PATTERNS
+    allowed = {pattern.strip() for pattern in allow_list}
+    return [pattern for pattern in patterns if pattern not in allowed]
+
+def get_driver(profile_dir=None):
     try:
+        webdriver = lazy_import("selenium.webdriver")
         options = webdriver.ChromeOptions()
         options.add_argument("--headless")
         options.add_argument("--no-sandbox")
         options.add_argument("--disable-dev-shm-usage")
-        service = Service()
+        if BLOCK_RESOURCES:
+            options.add_argument("--blink-settings=imagesEnabled=false")
+            options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+        if profile_dir:
+            # اسکریپت‌های سایت بین اجراها از کش دیسک پروفایل خوانده می‌شوند
+            os.makedirs(profile_dir, exist_ok=True)
+            options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
+            options.add_argument(f"--disk-cache-dir={os.path.abspath(os.path.join(profile_dir, 'cache'))}")
+            options.add_argument(f"--disk-cache-size={BROWSER_CACHE_SIZE}")
+        service = lazy_import("selenium.webdriver.chrome.service").Service()
         driver = webdriver.Chrome(service=service, options=options)
-        return driver
     except Exception as e:
+        if profile_dir:
+            # پروفایل ممکن است در دست مرورگر دیگری باشد؛ بدون پروفایل دوباره تلاش می‌شود
+            logging.warning("⚠️ ایجاد WebDriver با پروفایل %s ناموفق بود: %s", profile_dir, e)
+            return get_driver()
         logging.error(f"خطا در ایجاد WebDriver: {e}")
         return None
+    if BLOCK_RESOURCES:
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_url_patterns()})
+        except Exception as e:
+            logging.warning("⚠️ مسدودسازی درخواست‌ها با CDP فعال نشد: %s", e)
+    try:
+        # صفحه‌های طولانی بیش از ۲۵۰ درخواست دارند و بدون این آمار انتقال ناقص می‌ماند
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument",
+                               {"source": "performance.setResourceTimingBufferSize(10000);"})
+    except Exception:
+        pass
+    return driver
 
-def scroll_page(driver, scroll_pause_time=2):
-    last_height = driver.execute_script("return document.body.scrollHeight")
-    while True:
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(scroll_pause_time)
-        new_height = driver.execute_script("return document.body.scrollHeight")
-        if new_height == last_height:
-            break
-        last_height = new_height
+# حجم انتقال‌یافته و زمان بارگذاری صفحه جاری از Performance API؛ منابعی که از کش
+# خوانده شده‌اند transferSize صفر دارند
+PAGE_STATS_SCRIPT = """
+var nav = performance.getEntriesByType('navigation')[0];
+var resources = performance.getEntriesByType('resource');
+var bytes = nav ? nav.transferSize : 0, cached = 0;
+resources.forEach(function (r) {
+    bytes += r.transferSize;
+    if (r.transferSize === 0 && r.decodedBodySize > 0) { cached += 1; }
+});
+return {bytes: bytes, requests: resources.length + 1, cached: cached, loadMs: nav ? nav.domContentLoadedEventEnd : 0};
+"""
 
-def extract_product_data(driver, valid_brands):
-    product_elements = driver.find_elements(By.CLASS_NAME, 'mantine-Text-root')
+def page_stats(driver):
+    try:
+        return driver.execute_script(PAGE_STATS_SCRIPT)
+    except Exception as e:
+        logging.warning("⚠️ خواندن آمار بارگذاری صفحه ناموفق بود: %s", e)
+        return None
+
+# تا وقتی تعداد نودهای mantine-Text-root یا ارتفاع صفحه تغییر می‌کند اسکرول می‌کند و وقتی
+# به اندازه quiet_ms هیچ تغییری رخ ندهد و هیچ درخواست fetch/XHR در جریان نباشد برمی‌گردد.
+# پاسخ lazy-load از سرور ایران به CI ممکن است بیش از یک ثانیه طول بکشد؛ بدون شمارش
+# درخواست‌های در جریان، صفحه پیش از رسیدن آن آرام به نظر می‌رسد و کاتالوگ بی‌صدا کوتاه می‌شود
+SETTLE_SCRIPT = """
+var quietMs = arguments[0], maxMs = arguments[1], done = arguments[arguments.length - 1];
+var start = performance.now();
+var count = function () { return document.getElementsByClassName('mantine-Text-root').length; };
+var lastCount = count(), lastHeight = document.body.scrollHeight;
+var finished = false, quietTimer = null, capTimer = null, observer = null, pending = 0;
+var originalFetch = window.fetch, originalSend = XMLHttpRequest.prototype.send;
+var settled = function () {
+    pending = Math.max(0, pending - 1);
+    arm();
+};
+if (originalFetch) {
+    window.fetch = function () {
+        pending += 1;
+        arm();
+        return originalFetch.apply(this, arguments).finally(settled);
+    };
+}
+XMLHttpRequest.prototype.send = function () {
+    pending += 1;
+    arm();
+    this.addEventListener('loadend', settled);
+    return originalSend.apply(this, arguments);
+};
+var finish = function (timedOut) {
+    if (finished) { return; }
+    finished = true;
+    if (observer) { observer.disconnect(); }
+    if (originalFetch) { window.fetch = originalFetch; }
+    XMLHttpRequest.prototype.send = originalSend;
+    clearTimeout(quietTimer);
+    clearTimeout(capTimer);
+    done({elapsed: performance.now() - start, count: count(), timedOut: timedOut, pending: pending});
+};
+var arm = function () {
+    clearTimeout(quietTimer);
+    quietTimer = setTimeout(function () {
+        if (pending > 0) { arm(); } else { finish(false); }
+    }, quietMs);
+};
+observer = new MutationObserver(function () {
+    var c = count(), h = document.body.scrollHeight;
+    if (c !== lastCount || h !== lastHeight) {
+        lastCount = c;
+        lastHeight = h;
+        window.scrollTo(0, h);
+        arm();
+    }
+});
+observer.observe(document.body, {childList: true, subtree: true});
+capTimer = setTimeout(function () { finish(true); }, maxMs);
+window.scrollTo(0, document.body.scrollHeight);
+arm();
+"""
+
+def scroll_page(driver, quiet_period=SETTLE_QUIET_PERIOD, max_wait=SETTLE_MAX_WAIT):
+    driver.set_script_timeout(max_wait + 10)
+    result = driver.execute_async_script(SETTLE_SCRIPT, int(quiet_period * 1000), int(max_wait * 1000))
+    settle_time = result["elapsed"] / 1000
+    if result["timedOut"]:
+        logging.warning("⚠️ صفحه پس از %.1f ثانیه هنوز در حال بارگذاری بود (%d نود، %d درخواست در جریان).",
+                        settle_time, result["count"], result.get("pending", 0))
+    return settle_time
+
+# متن همه نودهای mantine-Text-root را در یک رفت‌وبرگشت برمی‌گرداند؛ برای هر نود مسیر شناسه
+# اجدادش (از بیرونی‌ترین تا خود نود) هم برگردانده می‌شود تا تشخیص کارت‌ها در assign_cards
+# برای Selenium و HTML خام یکسان باشد
+EXTRACT_SCRIPT = """
+var nodes = Array.prototype.slice.call(document.getElementsByClassName('mantine-Text-root'));
+var ids = new Map();
+function idOf(element) {
+    var id = ids.get(element);
+    if (id === undefined) { id = ids.size; ids.set(element, id); }
+    return id;
+}
+return nodes.map(function (node) {
+    var path = [];
+    for (var element = node; element && element !== document.documentElement; element = element.parentElement) {
+        path.push(idOf(element));
+    }
+    return {text: node.innerText || '', path: path.reverse()};
+});
+"""
+HEADER_TEXT_COUNT = 25
+
+def parse_product_texts(texts, valid_brands):
     brands, models = [], []
-    for product in product_elements:
-        name = product.text.strip().replace("تومانءء", "").replace("تومان", "").replace("نامشخص", "").replace("جستجو در مدل‌ها", "").strip()
+    for text in texts:
+        name = text.strip().replace("تومانءء", "").replace("تومان", "").replace("نامشخص", "").replace("جستجو در مدل‌ها", "").strip()
         parts = name.split()
         brand = parts[0] if len(parts) >= 2 else name
         model = " ".join(parts[1:]) if len(parts) >= 2 else ""
@@ -72,133 +379,840 @@ def extract_product_data(driver, valid_brands):
         else:
             models.append(brand + " " + model)
             brands.append("")
-    return brands[25:], models[25:]
+    return brands, models
+
+PRICE_TEXT = re.compile(r"تومان|نامشخص|^[\s\d۰-۹٬,]*[\d۰-۹]{3}[\s\d۰-۹٬,]*$")
+MAX_PRICES_PER_CARD = 12
+
+def is_price_text(text):
+    return bool(PRICE_TEXT.search(text.strip()))
+
+def card_children(items):
+    # برای هر عنصر: فرزندانی که متن دارند و اینکه هر فرزند نود قیمت و نود غیرقیمت (عنوان یا رنگ) دارد یا نه
+    children = {}
+    for item in items:
+        text = item["text"].strip()
+        if not text:
+            continue
+        price = is_price_text(text)
+        path = item["path"]
+        for depth, (parent, child) in enumerate(zip(path, path[1:])):
+            entry = children.setdefault(parent, (depth, {}))
+            flags = entry[1].setdefault(child, [False, False])
+            flags[0] = flags[0] or price
+            flags[1] = flags[1] or not price
+    return children
+
+def find_card_container(items):
+    # ظرف لیست عنصری است که هر فرزند دارای متنش هم قیمت دارد و هم متن غیرقیمت؛ یعنی هر فرزند
+    # یک کارت کامل است. ردیف‌های رنگ و قیمت یک کارت و نوار فیلترها این شرط را ندارند چون عنوان یا
+    # فیلتر بدون قیمت است. اگر چنین عنصری نبود (مثلاً کارتی بدون قیمت در لیست)، پایین‌ترین جد
+    # مشترک نودهای قیمت ظرف است و اگر خودش فرزند فقط‌قیمت داشته باشد، خودش تنها کارت صفحه است
+    children = card_children(items)
+    best, best_key = None, None
+    for element, (depth, kids) in children.items():
+        if all(flags[0] and flags[1] for flags in kids.values()):
+            key = (len(kids), depth)
+            if best_key is None or key > best_key:
+                best, best_key = element, key
+    if best is not None:
+        return best, False
+    prices = [item["path"][:-1] for item in items if item["text"].strip() and is_price_text(item["text"])]
+    if not prices:
+        return None, False
+    common = prices[0]
+    for path in prices[1:]:
+        length = 0
+        while length < min(len(common), len(path)) and common[length] == path[length]:
+            length += 1
+        common = common[:length]
+    if not common:
+        return None, False
+    container = common[-1]
+    kids = children.get(container, (0, {}))[1]
+    return container, any(flags[0] and not flags[1] for flags in kids.values())
+
+def assign_cards(items):
+    # شماره کارت هر نود (به ترتیب صفحه) یا -1 برای نودهای بیرون از لیست (فیلترها، جستجو و سربرگ)
+    container, single = find_card_container(items)
+    cards, result = {}, []
+    for item in items:
+        path = item["path"]
+        card = -1
+        if container in path:
+            index = path.index(container)
+            if single:
+                card = 0
+            elif index + 1 < len(path):
+                card = cards.setdefault(path[index + 1], len(cards))
+        result.append(card)
+    return result
+
+def select_card_texts(items):
+    # متن‌ها و شماره کارت هر متن؛ build_products جفت‌کردن رنگ و قیمت را در ابتدای هر کارت از نو شروع می‌کند
+    cards = assign_cards(items)
+    texts = [item["text"] for item, card in zip(items, cards) if card >= 0]
+    if not texts:
+        logging.warning("⚠️ کارت محصولات پیدا نشد؛ از رد کردن %d متن ابتدای صفحه استفاده می‌شود.", HEADER_TEXT_COUNT)
+        return [item["text"] for item in items][HEADER_TEXT_COUNT:], None
+    card_count = len(set(cards) - {-1})
+    price_count = sum(1 for item in items if item["text"].strip() and is_price_text(item["text"]))
+    if price_count > card_count * MAX_PRICES_PER_CARD:
+        logging.warning("⚠️ فقط %d کارت برای %d قیمت پیدا شد؛ ممکن است بخشی از محصولات از دست رفته باشد.", card_count, price_count)
+    return texts, [card for card in cards if card >= 0]
+
+def extract_card_products(items, valid_brands):
+    texts, cards = select_card_texts(items)
+    brands, models = parse_product_texts(texts, valid_brands)
+    return brands, models, cards
+
+def extract_product_data(driver, valid_brands):
+    return extract_card_products(driver.execute_script(EXTRACT_SCRIPT), valid_brands)
+
+def scrape_category(driver, url, valid_brands):
+    metrics.count("selenium.pages")
+    with metrics.span("selenium.get"):
+        driver.get(url)
+    with metrics.span("selenium.wait"):
+        ui = lazy_import("selenium.webdriver.support.ui")
+        conditions = lazy_import("selenium.webdriver.support.expected_conditions")
+        by = lazy_import("selenium.webdriver.common.by").By
+        ui.WebDriverWait(driver, 30).until(conditions.presence_of_element_located((by.CLASS_NAME, 'mantine-Text-root')))
+    with metrics.span("selenium.settle"):
+        settle_time = scroll_page(driver)
+    with metrics.span("selenium.extract"):
+        result = extract_product_data(driver, valid_brands)
+    stats = page_stats(driver)
+    if stats:
+        metrics.count("selenium.bytes_transferred", stats["bytes"])
+        metrics.count("selenium.requests", stats["requests"])
+        metrics.count("selenium.cached_requests", stats["cached"])
+        if metrics.enabled:
+            metrics.record("selenium.dom_content_loaded", stats["loadMs"] / 1000)
+    return result, settle_time, stats
+
+class DriverPool:
+    # مرورگرها بین دسته‌ها (و در حالت daemon بین اجراها) دوباره استفاده می‌شوند و
+    # مرورگری که دیگر پاسخ نمی‌دهد بسته و با یک مرورگر تازه جایگزین می‌شود. پروفایل دائمی
+    # (profile_dir) فقط در حالت daemon استفاده می‌شود؛ در اجرای یک‌باره کش دیسک آن به اجرای بعدی
+    # نمی‌رسد و ساخت پروفایل فقط هزینه اضافه است
+    def __init__(self, size=SCRAPE_WORKERS, profile_dir=None):
+        self.size = max(1, size)
+        self.profile_dir = profile_dir
+        self.idle = queue.LifoQueue()
+        self.drivers = []
+        self.profiles = {}
+        self.starting = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_create = len(self.drivers) + len(self.starting) < self.size
+                    if can_create:
+                        # پروفایل تا ساخته شدن مرورگر رزرو می‌شود تا دو ترد آن را نگیرند
+                        profile = self.free_profile()
+                        self.starting.append(profile)
+                if not can_create:
+                    driver = self.idle.get()
+                else:
+                    driver = None
+                    try:
+                        with metrics.span("selenium.start"):
+                            driver = get_driver(profile)
+                    finally:
+                        with self.lock:
+                            self.starting.remove(profile)
+                            if driver:
+                                self.drivers.append(driver)
+                                self.profiles[driver] = profile
+                    if not driver:
+                        raise RuntimeError("نمی‌توان WebDriver را ایجاد کرد.")
+                    return driver
+            if self.is_healthy(driver):
+                return driver
+            logging.warning("♻️ مرورگر پاسخ نمی‌دهد؛ مرورگر جدید ساخته می‌شود.")
+            metrics.count("selenium.restarts")
+            self.discard(driver)
+
+    def free_profile(self):
+        # هر مرورگر پروفایل و کش دیسک جداگانه‌ای دارد چون Chrome یک پروفایل را قفل می‌کند
+        if not self.profile_dir:
+            return None
+        used = set(self.profiles.values()) | set(self.starting)
+        for index in range(self.size):
+            profile = os.path.join(self.profile_dir, f"worker-{index}")
+            if profile not in used:
+                return profile
+        return None
+
+    def release(self, driver):
+        self.idle.put(driver)
+
+    def discard(self, driver):
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+            self.profiles.pop(driver, None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.warning("خطا در بستن WebDriver: %s", e)
+
+    def is_healthy(self, driver):
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def close(self):
+        with self.lock:
+            drivers, self.drivers = self.drivers, []
+            self.profiles = {}
+        while not self.idle.empty():
+            self.idle.get_nowait()
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logging.warning("خطا در بستن WebDriver: %s", e)
+
+def scrape_categories(categories_urls, valid_brands, max_workers=SCRAPE_WORKERS, driver_pool=None, on_result=None):
+    # هر ترد یک مرورگر headless از استخر می‌گیرد؛ نتایج به ترتیب دسته‌ها ادغام می‌شوند و
+    # در صورت وجود on_result هر دسته به محض تمام شدن (پس از آزاد شدن مرورگر) به آن داده می‌شود
+    items = list(categories_urls.items())
+    workers = max(1, min(max_workers, len(items)))
+    pool = driver_pool or DriverPool(workers)
+
+    def worker(item):
+        name, url = item
+        driver = pool.acquire()
+        try:
+            start = time.time()
+            with metrics.span(f"scrape.{name}"):
+                result, settle_time, stats = scrape_category(driver, url, valid_brands)
+        except Exception:
+            if pool.is_healthy(driver):
+                pool.release(driver)
+            else:
+                pool.discard(driver)
+            raise
+        pool.release(driver)
+        logging.info("📥 دسته %s در %.1f ثانیه استخراج شد (تثبیت صفحه: %.2f ثانیه).", name, time.time() - start, settle_time)
+        if stats:
+            logging.info("📦 دسته %s: %.0f KB در %d درخواست (%d از کش)، DOMContentLoaded در %.2f ثانیه.",
+                         name, stats["bytes"] / 1024, stats["requests"], stats["cached"], stats["loadMs"] / 1000)
+        if on_result is not None:
+            on_result(name, result)
+        return result
 
-def is_number(model_str):
     try:
-        float(model_str.replace(",", ""))
-        return True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(worker, items))
+    finally:
+        if driver_pool is None:
+            pool.close()
+    return dict(zip(categories_urls, results))
+
+_http_session = None
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        requests = lazy_import("requests")
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(4, SCRAPE_WORKERS))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+            "Accept-Language": "fa-IR,fa;q=0.9,en;q=0.8"
+        })
+        _http_session = session
+    return _http_session
+
+def find_card_items(nodes):
+    # نسخه پایتونی EXTRACT_SCRIPT برای HTML خام: متن و مسیر اجداد هر نود
+    ids = {}
+    items = []
+    for node in nodes:
+        path = []
+        element = node
+        while element is not None and element.name not in ("[document]", "html"):
+            path.append(ids.setdefault(id(element), len(ids)))
+            element = element.parent
+        items.append({"text": node.get_text(" ", strip=True), "path": path[::-1]})
+    return items
+
+def extract_product_data_from_html(html, valid_brands):
+    soup = lazy_import("bs4").BeautifulSoup(html, "html.parser")
+    nodes = soup.find_all(class_="mantine-Text-root")
+    if not nodes:
+        return [], [], []
+    return extract_card_products(find_card_items(nodes), valid_brands)
+
+NEXT_DATA_PATTERN = re.compile(r'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.S)
+TOTAL_KEYS = ("total", "totalCount", "total_count", "totalItems", "count")
+
+def embedded_item_total(html):
+    # تعداد کل محصولات از JSON جاسازی‌شده Next.js: فیلد شمارنده‌ای که کنار یک لیست از اشیا
+    # (پاسخ صفحه‌بندی‌شده) آمده است. HTML سرور ممکن است فقط دسته اول اسکرول بی‌پایان را داشته باشد
+    match = NEXT_DATA_PATTERN.search(html)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(1))
     except ValueError:
-        return False
+        return None
+    totals = []
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            lists = any(isinstance(item, list) and item and isinstance(item[0], dict) for item in value.values())
+            for key in TOTAL_KEYS:
+                if lists and isinstance(value.get(key), int) and not isinstance(value.get(key), bool):
+                    totals.append(value[key])
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return max(totals) if totals else None
 
-def process_model(model_str):
-    model_str = model_str.replace("٬", "").replace(",", "").strip()
-    if is_number(model_str):
-        model_value = float(model_str)
-        if model_value <= 1:
-            model_value_with_increase = model_value * 0
-        elif model_value <= 7000000:
-            model_value_with_increase = model_value + 260000
-        elif model_value <= 10000000:
-            model_value_with_increase = model_value * 1.035
-        elif model_value <= 20000000:
-            model_value_with_increase = model_value * 1.025
-        elif model_value <= 30000000:
-            model_value_with_increase = model_value * 1.02
-        elif model_value <= 40000000:
-            model_value_with_increase = model_value * 1.015
+def scrape_categories_http(categories_urls, valid_brands, max_workers=SCRAPE_WORKERS, on_result=None, expected_cards=None):
+    # صفحه‌ای که کامل بودنش معلوم نیست پذیرفته نمی‌شود تا با Selenium استخراج شود: تعداد کارت‌ها باید
+    # دست‌کم برابر تعداد کل JSON جاسازی‌شده یا تعداد کارت‌های آخرین استخراج امروز (expected_cards) باشد
+    expected_cards = expected_cards or {}
+    session = get_http_session()
+    items = list(categories_urls.items())
+    workers = max(1, min(max_workers, len(items)))
+
+    def worker(item):
+        name, url = item
+        start = time.time()
+        try:
+            with metrics.span("http.get"):
+                response = session.get(url, timeout=HTTP_TIMEOUT)
+            if metrics.enabled:
+                metrics.count("http.bytes_received", len(response.content))
+            response.raise_for_status()
+            if "charset" not in response.headers.get("Content-Type", ""):
+                # بدون charset کتابخانه requests متن را ISO-8859-1 فرض می‌کند و متن فارسی خراب می‌شود
+                response.encoding = "utf-8"
+            with metrics.span(f"scrape.{name}.parse"):
+                brands, models, cards = extract_product_data_from_html(response.text, valid_brands)
+                total = embedded_item_total(response.text)
+        except Exception as e:
+            logging.warning("⚠️ دریافت HTTP دسته %s ناموفق بود: %s", name, e)
+            return None
+        if not brands:
+            logging.warning("⚠️ در HTML دسته %s محصولی پیدا نشد.", name)
+            return None
+        count = len(set(cards or []))
+        required = total if total is not None else expected_cards.get(name)
+        if required is None:
+            logging.info("ℹ️ تعداد محصولات دسته %s معلوم نیست؛ کامل بودن HTML قابل بررسی نیست.", name)
+            return None
+        if count < required:
+            logging.warning("⚠️ HTML دسته %s فقط %d از %d محصول را دارد.", name, count, required)
+            metrics.count("http.incomplete_pages")
+            return None
+        logging.info("📥 دسته %s با HTTP در %.1f ثانیه استخراج شد.", name, time.time() - start)
+        if on_result is not None:
+            on_result(name, (brands, models, cards))
+        return brands, models, cards
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(worker, items))
+    return dict(zip(categories_urls, results))
+
+def scrape_catalog(categories_urls, valid_brands, backend=SCRAPER_BACKEND, driver_pool=None, on_result=None, expected_cards=None):
+    results = {}
+    if backend == "http":
+        results = scrape_categories_http(categories_urls, valid_brands, on_result=on_result, expected_cards=expected_cards)
+    missing = {name: url for name, url in categories_urls.items() if not results.get(name)}
+    if missing:
+        if backend == "http":
+            logging.info("🔁 استخراج دسته‌های %s با Selenium انجام می‌شود.", ", ".join(missing))
+        results.update(scrape_categories(missing, valid_brands, driver_pool=driver_pool, on_result=on_result))
+    brands, models, cards = [], [], []
+    for name in categories_urls:
+        b, m, c = results[name]
+        brands.extend(b)
+        models.extend(m)
+        # کارت‌های هر صفحه با نام صفحه از هم جدا می‌مانند
+        cards.extend([(name, card) for card in c] if c is not None else [None] * len(b))
+    return brands, models, cards
+
+def stream_catalog(categories_urls, valid_brands, backend=SCRAPER_BACKEND, driver_pool=None, maxsize=STREAM_QUEUE_SIZE, expected_cards=None):
+    # تولیدکننده: استخراج در پس‌زمینه ادامه پیدا می‌کند و هر دسته به محض تمام شدن
+    # از طریق یک صف محدود به مصرف‌کننده می‌رسد؛ خروجی (نام دسته، برندها، مدل‌ها، کارت‌ها، زمان استخراج) است
+    results = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            scrape_catalog(categories_urls, valid_brands, backend, driver_pool,
+                           on_result=lambda name, result: put((name, result, None)), expected_cards=expected_cards)
+        except Exception as e:
+            put((None, None, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        for _ in range(len(categories_urls)):
+            name, result, error = results.get()
+            if error is not None:
+                raise error
+            yield name, result[0], result[1], result[2], time.time()
+    finally:
+        stop.set()
+        thread.join()
+
+class PricingEngine:
+    # جدول پله‌های سود از فایل تنظیمات خوانده می‌شود؛ قیمت‌گذاری کل کاتالوگ با یک
+    # searchsorted روی مرز پله‌ها انجام می‌شود. پله‌های برند بر پله‌های دسته مقدم‌اند
+    def __init__(self, config):
+        self.rounding = config.get("rounding", -5)
+        self.default = self.compile_tiers(config["tiers"])
+        self.categories = {key: self.compile_tiers(tiers) for key, tiers in config.get("categories", {}).items()}
+        self.brands = {key: self.compile_tiers(tiers) for key, tiers in config.get("brands", {}).items()}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def compile_tiers(tiers):
+        tiers = list(tiers)
+        if not tiers or tiers[-1].get("up_to") is not None:
+            tiers.append({"up_to": None})
+        bounds = [tier["up_to"] for tier in tiers[:-1]]
+        if any(bound is None for bound in bounds) or bounds != sorted(bounds):
+            raise ValueError("مرز پله‌های قیمت باید صعودی باشد و فقط پله آخر بدون مرز باشد.")
+        numpy = lazy_import("numpy")
+        return (
+            numpy.array(bounds, dtype=float),
+            numpy.array([tier.get("factor", 1.0) for tier in tiers], dtype=float),
+            numpy.array([tier.get("add", 0.0) for tier in tiers], dtype=float)
+        )
+
+    def tiers_for(self, brand, category):
+        return self.brands.get(brand) or self.categories.get(category) or self.default
+
+    def price_many(self, values, brands=None, categories=None):
+        numpy = lazy_import("numpy")
+        values = numpy.asarray(values, dtype=float)
+        result = numpy.empty_like(values)
+        if brands is None and categories is None:
+            tables = {id(self.default): (self.default, numpy.arange(len(values)))}
         else:
-            model_value_with_increase = model_value * 1.015
-        model_value_with_increase = round(model_value_with_increase, -5)
-        return f"{model_value_with_increase:,.0f}"
-    return model_str
+            brands = brands if brands is not None else [""] * len(values)
+            categories = categories if categories is not None else [None] * len(values)
+            groups = {}
+            for i, (brand, category) in enumerate(zip(brands, categories)):
+                table = self.tiers_for(brand, category)
+                groups.setdefault(id(table), (table, []))[1].append(i)
+            tables = {key: (table, numpy.array(indices)) for key, (table, indices) in groups.items()}
+        for (bounds, factors, adds), indices in tables.values():
+            batch = values[indices]
+            tier = numpy.searchsorted(bounds, batch, side="left")
+            result[indices] = batch * factors[tier] + adds[tier]
+        return numpy.round(result, self.rounding)
+
+    def price(self, value, brand="", category=None):
+        return float(self.price_many([value], [brand], [category])[0])
+
+_pricing_engine = None
+
+def get_pricing_engine():
+    global _pricing_engine
+    if _pricing_engine is None:
+        _pricing_engine = PricingEngine.from_file(PRICING_CONFIG_PATH)
+    return _pricing_engine
+
+def price_products(products, engine=None):
+    engine = engine or get_pricing_engine()
+    priced = [product for product in products if product.raw_price is not None]
+    if not priced:
+        return products
+    prices = engine.price_many(
+        [product.raw_price for product in priced],
+        [product.brand for product in priced],
+        [product.category for product in priced]
+    )
+    for product, price in zip(priced, prices.tolist()):
+        product.price = price
+    return products
+
+# همه کاراکترهای رزرو‌شده MarkdownV2؛ برای متن فارسی چند replace سریع‌تر از str.translate است
+MARKDOWN_V2_SPECIAL_CHARS = ['\\', '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
 
 def escape_special_characters(text):
-    escape_chars = ['\\', '(', ')', '[', ']', '~', '*', '_', '-', '+', '>', '#', '.', '!', '|']
-    for char in escape_chars:
-        text = text.replace(char, '\\' + char)
+    for char in MARKDOWN_V2_SPECIAL_CHARS:
+        if char in text:
+            text = text.replace(char, '\\' + char)
     return text
 
-def split_message_by_emoji_group(message, max_length=4000):
-    lines = message.split('\n')
+def utf16_length(text):
+    # محدودیت طول پیام تلگرام بر حسب واحدهای UTF-16 است و هر ایموجی دو واحد حساب می‌شود
+    return len(text.encode("utf-16-le")) // 2
+
+@functools.lru_cache(maxsize=65536)
+def cached_utf16_length(text):
+    # بلوک محصولاتی که تغییر نکرده‌اند بین دسته‌ها و (در حالت daemon) بین اجراها دوباره اندازه‌گیری نمی‌شوند
+    return utf16_length(text)
+
+def make_block(key, text):
+    return (key, text, cached_utf16_length(text))
+
+class MessagePart:
+    # متن خام (برای مقایسه و ذخیره) و طول UTF-16 یک پارت؛ متن فرار داده‌شده فقط
+    # برای پارت‌هایی که واقعاً ارسال یا ویرایش می‌شوند و فقط یک بار ساخته می‌شود
+    __slots__ = ("text", "_escaped", "length")
+
+    def __init__(self, text, escaped=None, length=None):
+        self.text = text
+        self._escaped = escaped
+        self.length = utf16_length(text) if length is None else length
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        text = "".join(block[1] for block in blocks)
+        stripped = text.rstrip('\n')
+        return cls(stripped, length=sum(block[2] for block in blocks) - (len(text) - len(stripped)))
+
+    @property
+    def escaped(self):
+        if self._escaped is None:
+            self._escaped = escape_special_characters(self.text)
+        return self._escaped
+
+    def prefixed(self, prefix):
+        escaped = None if self._escaped is None else escape_special_characters(prefix) + self._escaped
+        return MessagePart(prefix + self.text, escaped, utf16_length(prefix) + self.length)
+
+def split_message_blocks(message):
+    # هر بلوک یک محصول (خط ایموجی‌دار و رنگ‌ها و قیمت‌هایش) است؛ سربرگ پیام کلید None دارد
+    blocks = []
+    key, text = None, ""
+    for line in message.split('\n'):
+        if line.startswith(CATEGORY_EMOJIS):
+            if text:
+                blocks.append(make_block(key, text))
+            key, text = line.strip(), ""
+        text += line + '\n'
+    if text:
+        blocks.append(make_block(key, text))
+    return blocks
+
+def blocks_length(blocks):
+    return sum(block[2] for block in blocks)
+
+def pack_blocks(blocks, limit):
     parts = []
-    current = ""
-    group = ""
-    for line in lines:
-        if line.startswith(('🔵', '🟡', '🍏', '🟣', '💻', '🟠', '🎮')):
-            # اگر گروه فعلی با اضافه کردن گروه جدید از حد مجاز بیشتر می‌شود، پارت جدید بساز
-            if current and len(current) + len(group) > max_length:
-                parts.append(current.rstrip('\n'))
-                current = ""
-            current += group
-            group = ""
-        group += line + '\n'
-    # اضافه کردن آخرین گروه
-    if current and len(current) + len(group) > max_length:
-        parts.append(current.rstrip('\n'))
-        current = ""
-    current += group
-    if current.strip():
-        parts.append(current.rstrip('\n'))
+    current = []
+    size = 0
+    for block in blocks:
+        # اگر گروه فعلی با اضافه کردن گروه جدید از حد مجاز بیشتر می‌شود، پارت جدید بساز
+        if current and size + block[2] > limit:
+            parts.append(current)
+            current, size = [], 0
+        current.append(block)
+        size += block[2]
+    if current:
+        parts.append(current)
     return parts
 
-def decorate_line(line):
-    if line.startswith(('🔵', '🟡', '🍏', '🟣', '💻', '🟠', '🎮')):
-        return line  
-    if any(keyword in line for keyword in ["Nartab", "Tab", "تبلت"]):
-        return f"🟠 {line}"
-    elif "Galaxy" in line:
-        return f"🔵 {line}"
-    elif "POCO" in line or "Poco" in line or "Redmi" in line:
-        return f"🟡 {line}"
-    elif "iPhone" in line:
-        return f"🍏 {line}"
-    elif any(keyword in line for keyword in ["اینچی", "لپ تاپ"]):
-        return f"💻 {line}"   
-    elif any(keyword in line for keyword in ["RAM", "FA", "Classic", "Otel", "DOX", "General", "Bloom", "NOKIA", "Nokia", "Zhivaco", "Hanofer", "TCH", "ALCATEL"]): 
-        return f"🟣 {line}"
-    elif any(keyword in line for keyword in ["Play Station", "کنسول بازی", "پلی استیشن", "بازی"]):
-        return f"🎮 {line}"
+def occurrence_keys(keys):
+    # مدل‌های هم‌نام با شماره تکرارشان از هم جدا می‌شوند
+    seen = {}
+    result = []
+    for key in keys:
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        result.append((key, count))
+    return result
+
+def previous_part_labels(previous_parts):
+    keys, indexes = [], []
+    for index, text in enumerate(previous_parts):
+        for line in text.split('\n'):
+            if line.startswith(CATEGORY_EMOJIS):
+                keys.append(line.strip())
+                indexes.append(index)
+    return dict(zip(occurrence_keys(keys), indexes))
+
+def longest_non_decreasing(values):
+    # اندیس‌های بلندترین زیردنباله غیرنزولی، با روش patience sorting
+    tails, tail_index, parent = [], [], [None] * len(values)
+    for i, value in enumerate(values):
+        pos = bisect.bisect_right(tails, value)
+        if pos > 0:
+            parent[i] = tail_index[pos - 1]
+        if pos == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[pos] = value
+            tail_index[pos] = i
+    result = []
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        result.append(i)
+        i = parent[i]
+    return result[::-1]
+
+def stable_partition(blocks, previous_parts, max_length):
+    # محصولاتی که در اجرای قبل در یک پارت بودند در همان پارت می‌مانند؛ محصولات جدید یا
+    # جابه‌جاشده به پارت محصول قبلی خود می‌روند و فقط پارت‌های سرریز شده دوباره تقسیم می‌شوند
+    labels = previous_part_labels(previous_parts)
+    keys = occurrence_keys([block[0] for block in blocks])
+    known = [i for i, block in enumerate(blocks) if block[0] is not None and keys[i] in labels]
+    anchors = set(known[j] for j in longest_non_decreasing([labels[keys[i]] for i in known]))
+    grouped = {}
+    current = 0
+    for i, block in enumerate(blocks):
+        if i in anchors:
+            current = labels[keys[i]]
+        grouped.setdefault(current, []).append(block)
+    parts = [grouped[label] for label in sorted(grouped)]
+    i = 0
+    while i < len(parts):
+        while len(parts[i]) > 1 and blocks_length(parts[i]) > max_length:
+            if i + 1 == len(parts):
+                parts.append([])
+            parts[i + 1].insert(0, parts[i].pop())
+        i += 1
+    return parts
+
+def strip_part_timestamp(text):
+    first, _, rest = text.partition('\n')
+    if first.startswith("⏰ "):
+        return rest
+    return re.sub(r"🕓 ساعت: \d{1,2}:\d{2}", "", first) + '\n' + rest
+
+def reuse_unchanged_parts(parts, previous_parts):
+    # پارتی که جز ساعت بروزرسانی تغییری نکرده همان متن قبلی را نگه می‌دارد تا ویرایش نشود
+    result = []
+    for i, part in enumerate(parts):
+        if i < len(previous_parts) and strip_part_timestamp(previous_parts[i]) == strip_part_timestamp(part.text):
+            result.append(MessagePart(previous_parts[i]))
+        else:
+            result.append(part)
+    return result
+
+def split_blocks(blocks, max_length=4000, previous_parts=None, slack=MESSAGE_PART_SLACK):
+    # max_length بر حسب واحدهای UTF-16 متن خام است؛ تلگرام طول را پس از پردازش MarkdownV2 می‌سنجد
+    if previous_parts:
+        parts = stable_partition(blocks, previous_parts, max_length)
     else:
-        return line
+        # در تقسیم اولیه کمی جای خالی باقی می‌ماند تا محصولات جدید مرز پارت‌ها را جابه‌جا نکنند
+        parts = pack_blocks(blocks, max(max_length - slack, max_length // 2))
+    result = []
+    for part in parts:
+        message_part = MessagePart.from_blocks(part)
+        if message_part.text.strip():
+            result.append(message_part)
+    return result
+
+def split_message_by_emoji_group(message, max_length=4000, previous_parts=None, slack=MESSAGE_PART_SLACK):
+    return [part.text for part in split_blocks(split_message_blocks(message), max_length, previous_parts, slack)]
+
+class CategoryClassifier:
+    # جدول قواعد (کلمه کلیدی ← ایموجی دسته با اولویت) یک بار به یک regex با lookahead تبدیل می‌شود
+    # تا همه کلمات (حتی هم‌پوشان) در یک پیمایش پیدا شوند؛ کمترین عدد اولویت برنده است
+    def __init__(self, rules):
+        self.rules = {}
+        for rank, rule in enumerate(rules):
+            priority = rule.get("priority", rank)
+            for keyword in rule["keywords"]:
+                current = self.rules.get(keyword)
+                if current is None or priority < current[0]:
+                    self.rules[keyword] = (priority, rule["category"])
+        # در هر موقعیت، کلمه با اولویت بالاتر (و بعد طولانی‌تر) اول امتحان می‌شود
+        keywords = sorted(self.rules, key=lambda keyword: (self.rules[keyword][0], -len(keyword)))
+        self.pattern = re.compile("(?=(" + "|".join(re.escape(keyword) for keyword in keywords) + "))") if keywords else None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def classify(self, line):
+        return self.classify_many([line])[0]
+
+    def classify_many(self, lines):
+        result = [None] * len(lines)
+        best = [None] * len(lines)
+        for i, line in enumerate(lines):
+            if line.startswith(CATEGORY_EMOJIS):
+                result[i] = line[0]
+        if self.pattern is None:
+            return result
+        starts = []
+        offset = 0
+        for line in lines:
+            starts.append(offset)
+            offset += len(line) + 1
+        for match in self.pattern.finditer("\n".join(lines)):
+            i = bisect.bisect_right(starts, match.start()) - 1
+            if result[i] is not None and best[i] is None:
+                continue
+            rule = self.rules[match.group(1)]
+            if best[i] is None or rule[0] < best[i][0]:
+                best[i] = rule
+                result[i] = rule[1]
+        return result
+
+_category_classifier = None
+
+def get_category_classifier():
+    global _category_classifier
+    if _category_classifier is None:
+        _category_classifier = CategoryClassifier.from_file(CATEGORY_RULES_PATH)
+    return _category_classifier
+
+class Product:
+    # هر رکورد یک رنگ (variant) از یک مدل است؛ مدلی که رنگی ندارد variant برابر None دارد.
+    # group شماره ترتیب مدل در صفحه است تا رنگ‌های یک آگهی کنار هم بمانند
+    __slots__ = ("brand", "model", "variant", "raw_price", "price", "category", "label", "group")
+
+    def __init__(self, brand, model, category, variant=None, raw_price=None, price=None, label=None, group=0):
+        self.brand = brand
+        self.model = model
+        self.category = category
+        self.variant = variant
+        self.raw_price = raw_price
+        self.price = price
+        self.label = label
+        self.group = group
+
+    @property
+    def title(self):
+        return f"{self.model} {self.brand}".strip()
+
+    def group_key(self):
+        return (self.group, self.category, self.brand, self.model)
+
+    def line(self):
+        return render_product_line(self.variant, self.price, self.label)
+
+    def fingerprint_line(self):
+        return f"{self.category}|{self.brand}|{self.model}|{self.variant}|{self.raw_price}|{self.price}|{self.label}"
+
+@functools.lru_cache(maxsize=65536)
+def render_product_line(variant, price, label):
+    # خط هر رنگ در پیام دسته؛ بیشتر قیمت‌ها بین اجراها ثابت‌اند و دوباره قالب‌بندی نمی‌شوند
+    price_text = f"{price:,.0f}" if price is not None else label
+    line = variant if price_text is None else f"{variant} | {price_text}"
+    if any(emoji in line for emoji in CATEGORY_EMOJIS) and "|" in line:
+        return None
+    return line
+
+def parse_price(text):
+    text = text.replace("٬", "").replace(",", "").strip()
+    try:
+        return float(text), text
+    except ValueError:
+        return None, text
+
+def build_products(brands, models, group_base=0, cards=None):
+    # هر متن صفحه یک بار تحلیل می‌شود: خطی که دسته‌بندی می‌شود عنوان مدل است و
+    # خطوط بعدی دوتا دوتا (رنگ، قیمت) رنگ‌های همان مدل هستند. با cards (شماره کارت هر متن)
+    # جفت‌کردن در ابتدای هر کارت از نو شروع می‌شود تا یک متن جاافتاده به کارت‌های بعدی سرایت نکند.
+    # group_base شماره گروه‌های صفحه‌های مختلف را از هم جدا نگه می‌دارد
+    if cards is None:
+        cards = [None] * len(brands)
+    items = []
+    for brand, model, card in zip(brands, models, cards):
+        model = model.replace("٬", "").replace(",", "").strip()
+        items.append((brand, model, f"{model} {brand}".strip(), card))
+    # متن خالی (مثلاً قیمت «نامشخص») نمی‌تواند عنوان باشد ولی جایش در جفت‌های (رنگ، قیمت) می‌ماند
+    # تا جفت‌های بعدی همان کارت جابه‌جا نشوند
+    categories = get_category_classifier().classify_many([item[2] for item in items])
+    items = [item + (category if item[2] else None,) for item, category in zip(items, categories)]
+    products = []
+    current = None
+    pending = []
+
+    def close_group():
+        if current is None:
+            return
+        if not pending:
+            products.append(Product(current[0], current[1], current[2], group=current[3]))
+            return
+        i = 0
+        while i < len(pending):
+            if i + 1 < len(pending):
+                raw_price, label = parse_price(pending[i + 1])
+                products.append(Product(current[0], current[1], current[2], variant=pending[i],
+                                        raw_price=raw_price,
+                                        label=None if raw_price is not None else label, group=current[3]))
+                i += 2
+            else:
+                products.append(Product(current[0], current[1], current[2], variant=pending[i], group=current[3]))
+                i += 1
+
+    previous_card = None
+    for brand, model, line, card, category in items:
+        if card != previous_card:
+            close_group()
+            current = None
+            pending = []
+            previous_card = card
+        if category:
+            close_group()
+            current = (brand, model, category, group_base + len(products))
+            pending = []
+        elif current is not None:
+            pending.append(line)
+    close_group()
+    return price_products(products)
 
-def sort_lines_together_by_price(lines):
+def group_products(products):
+    groups = []
+    for product in products:
+        if groups and groups[-1][0].group_key() == product.group_key():
+            groups[-1].append(product)
+        else:
+            groups.append([product])
+    return groups
+
+def sort_groups_by_price(groups):
     def extract_price(group):
-        for line in reversed(group):
-            parts = line.split()
-            for part in parts:
-                try:
-                    return float(part.replace(',', '').replace('،', ''))
-                except ValueError:
-                    continue
+        for product in reversed(group):
+            if product.price is not None:
+                return product.price
         return float('inf')
-    grouped_lines = []
-    current_group = []
-    for line in lines:
-        if line.startswith(("🔵", "🟡", "🍏", "🟣", "💻", "🟠", "🎮")):
-            if current_group:
-                grouped_lines.append(current_group)
-            current_group = [line]
-        else:
-            current_group.append(line)
-    if current_group:
-        grouped_lines.append(current_group)
-    grouped_lines.sort(key=extract_price)
-    sorted_lines = [line for group in grouped_lines for line in group]
-    return sorted_lines
-
-def remove_extra_blank_lines(lines):
-    cleaned_lines = []
-    blank_count = 0
-    for line in lines:
-        if line.strip() == "":
-            blank_count += 1
-            if blank_count <= 1:
-                cleaned_lines.append(line)
-        else:
-            blank_count = 0
-            cleaned_lines.append(line)
-    return cleaned_lines
+    return sorted(groups, key=extract_price)
+
+CATEGORY_TIME_PATTERN = re.compile(r"🕓 ساعت: \d{2}:\d{2}")
 
 def get_current_time():
-    iran_tz = timezone('Asia/Tehran')
-    iran_time = datetime.now(iran_tz)
+    iran_time = datetime.now(TEHRAN_TZ)
     current_time = iran_time.strftime('%H:%M')
     return current_time
 
-def prepare_final_message(category_name, category_lines, update_date):
+DEFAULT_CATEGORY_FOOTER = "\n\n☎️ شماره های تماس :\n📞 09371111558\n📞 02833991417"
+
+def render_category_blocks(category_name, category_groups, update_date, footer=DEFAULT_CATEGORY_FOOTER):
+    # پیام دسته مستقیماً به صورت بلوک‌های آماده تقسیم (کلید، متن، طول UTF-16) ساخته می‌شود
+    # تا لازم نباشد متن کامل دوباره به خطوط شکسته و اندازه‌گیری شود
     category_title = get_category_name(category_name)
-    update_date = JalaliDate.today().strftime("%Y/%m/%d")
+    today = jalali_today()
+    update_date = today.strftime("%Y/%m/%d")
     current_time = get_current_time()
     weekday_mapping = {
             "Saturday": "شنبه💪",
@@ -209,7 +1223,7 @@ def prepare_final_message(category_name, category_lines, update_date):
             "Thursday": "پنج شنبه☺️",
             "Friday": "جمعه😎"
     }
-    weekday_english = JalaliDate.today().weekday()
+    weekday_english = today.weekday()
     weekday_farsi = list(weekday_mapping.values())[weekday_english]
     update_date_formatted = f"{weekday_farsi} {update_date.replace('-', '/')}"
     header = (
@@ -217,41 +1231,24 @@ def prepare_final_message(category_name, category_lines, update_date):
         f"✅ لیست پخش موبایل اهورا\n\n"
         f"⬅️ موجودی {category_title} ➡️\n\n"
     )
-    formatted_lines = []
-    current_product = None
-    product_variants = []
-    i = 0
-    while i < len(category_lines):
-        line = category_lines[i]
-        if line.startswith(("🔵", "🟡", "🍏", "🟣", "💻", "🟠", "🎮")):
-            if current_product:
-                formatted_lines.append(current_product)
-                if product_variants:
-                    formatted_lines.extend(product_variants)
-                formatted_lines.append("")
-                product_variants = []
-            current_product = line.strip()
-            i += 1
-        else:
-            if i + 1 < len(category_lines):
-                color = line.strip()
-                price = category_lines[i + 1].strip()
-                product_variants.append(f"{color} | {price}")
-                i += 2
-            else:
-                product_variants.append(line.strip())
-                i += 1
-    if current_product:
-        formatted_lines.append(current_product)
-        if product_variants:
-            formatted_lines.extend(product_variants)
-    formatted_lines = [
-        line for line in formatted_lines
-        if not any(emoji in line for emoji in ["🔵", "🟡", "🍏", "🟣", "💻", "🟠", "🎮"]) or "|" not in line
-    ]
-    footer = "\n\n☎️ شماره های تماس :\n📞 09371111558\n📞 02833991417"
-    final_message = f"{header}" + "\n".join(formatted_lines) + f"{footer}"
-    return final_message
+    if not category_groups:
+        return [make_block(None, header + footer + "\n")]
+    blocks = [(None, header, utf16_length(header))]
+    for index, group in enumerate(category_groups):
+        lines = [f"{category_name} {group[0].title}"]
+        for product in group:
+            if product.variant is None:
+                continue
+            line = product.line()
+            if line is not None:
+                lines.append(line)
+        tail = footer + "\n" if index == len(category_groups) - 1 else "\n\n"
+        blocks.append(make_block(lines[0].strip(), "\n".join(lines) + tail))
+    return blocks
+
+def prepare_final_message(category_name, category_groups, update_date, footer=DEFAULT_CATEGORY_FOOTER):
+    blocks = render_category_blocks(category_name, category_groups, update_date, footer)
+    return "".join(block[1] for block in blocks)[:-1]
 
 def get_category_name(emoji):
     mapping = {
@@ -265,291 +1262,1384 @@ def get_category_name(emoji):
     }
     return mapping.get(emoji, "گوشیای متفرقه")
 
-def categorize_messages(lines):
-    categories = {"🔵": [], "🟡": [], "🍏": [], "🟣": [], "💻": [], "🟠": [], "🎮": []}
-    current_category = None
-    for line in lines:
-        if line.startswith("🔵"):
-            current_category = "🔵"
-        elif line.startswith("🟡"):
-            current_category = "🟡"
-        elif line.startswith("🍏"):
-            current_category = "🍏"
-        elif line.startswith("🟣"):
-            current_category = "🟣"
-        elif line.startswith("💻"):
-            current_category = "💻"
-        elif line.startswith("🟠"):
-            current_category = "🟠"
-        elif line.startswith("🎮"):
-            current_category = "🎮"
-        if current_category:
-            categories[current_category].append(line)
+def categorize_products(products):
+    categories = {emoji: [] for emoji in CATEGORY_EMOJIS}
+    for group in group_products(products):
+        categories[group[0].category].append(group)
     for category in categories:
-        categories[category] = sort_lines_together_by_price(categories[category])
-        categories[category] = remove_extra_blank_lines(categories[category])
+        categories[category] = sort_groups_by_price(categories[category])
     return categories
 
+SHEET_SCOPES = ("https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive")
+
 def get_credentials():
     encoded = os.getenv("GSHEET_CREDENTIALS_JSON")
     if not encoded:
         raise Exception("Google Sheets credentials not found in environment variable")
-    decoded = base64.b64decode(encoded)
-    temp_path = "/tmp/creds.json"
-    with open(temp_path, "wb") as f:
-        f.write(decoded)
-    return temp_path
+    return json.loads(base64.b64decode(encoded))
+
+def token_cache_path(info, scopes, cache_dir=TOKEN_CACHE_DIR):
+    # هر حساب سرویس و مجموعه scope فایل جداگانه دارد تا توکن اشتباهی دوباره استفاده نشود
+    key = json.dumps([info.get("client_email"), sorted(scopes)])
+    return os.path.join(cache_dir, f"token-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.json")
+
+def utc_now():
+    # google-auth زمان انقضا را به صورت UTC بدون منطقه زمانی نگه می‌دارد
+    return datetime.now(dt_timezone.utc).replace(tzinfo=None)
+
+def load_cached_token(path, margin=TOKEN_EXPIRY_MARGIN):
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        expiry = datetime.strptime(cached["expiry"], "%Y-%m-%dT%H:%M:%S")
+        token = cached["token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if expiry - utc_now() < timedelta(seconds=margin):
+        return None
+    return token, expiry
+
+def save_cached_token(path, token, expiry):
+    # پوشه فقط برای کاربر جاری (0700) و فایل فقط قابل خواندن برای او (0600) است
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.chmod(directory, 0o700)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"token": token, "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+    os.replace(temp_path, path)
+
+def remember_token(path, credentials):
+    try:
+        save_cached_token(path, credentials.token, credentials.expiry)
+    except OSError as e:
+        logging.warning("⚠️ ذخیره توکن گوگل در کش ناموفق بود: %s", e)
+
+def get_sheet_credentials(scopes=SHEET_SCOPES):
+    # توکن دسترسی تا پیش از انقضا از کش دیسک خوانده می‌شود و فقط در نبود آن تبادل OAuth انجام می‌شود
+    started = time.perf_counter()
+    info = get_credentials()
+    service_account = lazy_import("google.oauth2.service_account")
+    credentials = service_account.Credentials.from_service_account_info(info, scopes=list(scopes))
+    path = token_cache_path(info, scopes)
+    cached = load_cached_token(path)
+    if cached:
+        credentials.token, credentials.expiry = cached
+        metrics.count("auth.token_cache_hits")
+        startup_timings["auth.cached"] = time.perf_counter() - started
+        return credentials, path
+    with metrics.span("auth.refresh"):
+        credentials.refresh(lazy_import("google.auth.transport.requests").Request())
+    remember_token(path, credentials)
+    startup_timings["auth.refresh"] = time.perf_counter() - started
+    return credentials, path
 
 def connect_to_sheet():
-    creds_path = get_credentials()
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(creds_path, scope)
-    client = gspread.authorize(credentials)
+    credentials, token_path = get_sheet_credentials()
+    token = credentials.token
+    client = lazy_import("gspread").authorize(credentials)
     sheet = client.open_by_key(SPREADSHEET_ID).worksheet(SHEET_NAME)
+    if credentials.token != token:
+        # توکن کش‌شده رد شد و gspread آن را تازه کرد
+        remember_token(token_path, credentials)
     return sheet
 
-def check_and_create_headers(sheet):
-    first_row = sheet.get_all_values()[0] if sheet.get_all_values() else []
-    headers = ["emoji", "date", "part", "message_id", "text"]
-    if first_row != headers:
-        sheet.update(values=[headers], range_name="A1:E1")
+_sheet = None
+
+def get_sheet():
+    global _sheet
+    if _sheet is None:
+        with metrics.span("sheets.connect"):
+            _sheet = connect_to_sheet()
+    return _sheet
+
+SHEET_HEADERS = ["emoji", "date", "part", "message_id", "text"]
+
+def parse_sheet_value(value):
+    if isinstance(value, str) and value.lstrip("-").isdigit():
+        return int(value)
+    return value
+
+# کلیدهای ردیف‌های حسابداری (اثر انگشت‌ها، صفحه‌های منبع هر دسته و تعداد کارت‌های هر صفحه)
+FINGERPRINT_KEY = "FINGERPRINT"
+SOURCES_KEY = "SOURCES"
+CARDS_KEY = "CARDS"
+BOOKKEEPING_KEYS = (FINGERPRINT_KEY, SOURCES_KEY, CARDS_KEY)
+
+class MessageStore(abc.ABC):
+    # رابط مشترک ذخیره‌سازی شناسه پیام‌ها؛ هر ردیف [emoji, date, part, message_id, text] است.
+    # مقدارهای حسابداری به طور پیش‌فرض به صورت ردیف یک‌پارتی با متن همان مقدار ذخیره می‌شوند
+    @abc.abstractmethod
+    def rows_for(self, emoji, date):
+        pass
+
+    @abc.abstractmethod
+    def all_rows(self):
+        pass
+
+    @abc.abstractmethod
+    def replace(self, emoji, date, rows):
+        pass
+
+    @abc.abstractmethod
+    def prune(self, keep_date):
+        pass
+
+    def get_value(self, key, date):
+        for _, _, _, _, text in self.rows_for(key, date):
+            return text
+        return None
+
+    def set_value(self, key, date, value):
+        self.replace(key, date, [[key, date, 1, "", value]])
+
+    def flush(self):
+        return False
+
+    def close(self):
+        pass
+
+class SheetMessageStore(MessageStore):
+    # کل شیت یک بار در هر اجرا خوانده می‌شود، تغییرات در حافظه اعمال می‌شوند
+    # و در پایان با یک درخواست update نوشته می‌شوند
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.header = []
+        self.rows = []
+        self.loaded_row_count = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with metrics.span("sheets.read"):
+            values = self.sheet.get_all_values()
+        metrics.count("sheets.rows_read", len(values))
+        self.loaded_row_count = len(values)
+        self.header = values[0] if values else []
+        self.rows = []
+        for row in values[1:]:
+            row = (list(row) + [""] * len(SHEET_HEADERS))[:len(SHEET_HEADERS)]
+            emoji, date, part, message_id, text = row
+            if not emoji or not date:
+                continue
+            self.rows.append([emoji, date, int(part or 1), parse_sheet_value(message_id), text])
+        self.dirty = False
+        return self
+
+    def rows_for(self, emoji, date):
+        with self.lock:
+            rows = [list(row) for row in self.rows if row[0] == emoji and row[1] == date]
+        return sorted(rows, key=lambda row: row[2])
+
+    def all_rows(self):
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def replace(self, emoji, date, rows):
+        with self.lock:
+            self.rows = [row for row in self.rows if not (row[0] == emoji and row[1] == date)]
+            self.rows.extend(list(row) for row in rows)
+            self.dirty = True
+
+    def prune(self, keep_date):
+        with self.lock:
+            kept = [row for row in self.rows if row[1] == keep_date]
+            if len(kept) != len(self.rows):
+                logging.info("🧹 %d ردیف قدیمی از شیت حذف می‌شود.", len(self.rows) - len(kept))
+                self.rows = kept
+                self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return False
+            values = [SHEET_HEADERS] + [list(row) for row in self.rows]
+            total = max(len(values), self.loaded_row_count)
+            # ردیف‌های اضافه قبلی با مقدار خالی بازنویسی می‌شوند تا فقط یک درخواست لازم باشد
+            values += [[""] * len(SHEET_HEADERS)] * (total - len(values))
+            if total > self.sheet.row_count:
+                with metrics.span("sheets.add_rows"):
+                    self.sheet.add_rows(total - self.sheet.row_count)
+            with metrics.span("sheets.write"):
+                self.sheet.update(values=values, range_name=f"A1:E{total}")
+            metrics.count("sheets.rows_written", total)
+            self.header = list(SHEET_HEADERS)
+            self.loaded_row_count = len(self.rows) + 1
+            self.dirty = False
+            logging.info("💾 %d ردیف در شیت ذخیره شد.", len(self.rows))
+            return True
+
+class SheetMirror:
+    # نسخه‌ای از وضعیت را برای خواندن انسانی در گوگل شیت نگه می‌دارد؛ نوشتن در پس‌زمینه انجام می‌شود
+    def __init__(self, connect):
+        self.connect = connect
+        self.sheet = None
+        self.thread = None
+
+    def get_sheet(self):
+        if self.sheet is None:
+            self.sheet = self.connect()
+        return self.sheet
+
+    def fetch(self):
+        return SheetMessageStore(self.get_sheet()).load().all_rows()
+
+    def write(self, rows):
+        try:
+            store = SheetMessageStore(self.get_sheet()).load()
+            store.rows = rows
+            store.dirty = True
+            store.flush()
+        except Exception as e:
+            logging.warning("⚠️ به‌روزرسانی نسخه گوگل شیت ناموفق بود: %s", e)
+
+    def push(self, rows):
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(rows,), daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=SHEET_MIRROR_TIMEOUT):
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logging.warning("⚠️ نوشتن در گوگل شیت هنوز تمام نشده است.")
+            self.thread = None
+
+class SQLiteMessageStore(MessageStore):
+    # ردیف‌های حسابداری در جدول جداگانه bookkeeping ذخیره می‌شوند تا به نسخه گوگل شیت نرسند
+    def __init__(self, path, mirror=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.mirror = mirror
+        self.dirty = False
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "emoji TEXT NOT NULL, date TEXT NOT NULL, part INTEGER NOT NULL, "
+                "message_id INTEGER, text TEXT, "
+                "PRIMARY KEY (emoji, date, part)) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS bookkeeping ("
+                "key TEXT NOT NULL, date TEXT NOT NULL, value TEXT, "
+                "PRIMARY KEY (key, date)) WITHOUT ROWID"
+            )
+            # دیتابیس‌های قدیمی این ردیف‌ها را در جدول messages داشتند
+            where = " OR ".join("emoji LIKE ?" for _ in BOOKKEEPING_KEYS)
+            patterns = [f"{key}%" for key in BOOKKEEPING_KEYS]
+            self.conn.execute(f"INSERT OR REPLACE INTO bookkeeping SELECT emoji, date, text FROM messages WHERE {where}", patterns)
+            if self.conn.execute(f"DELETE FROM messages WHERE {where}", patterns).rowcount:
+                self.dirty = True
+
+    def bootstrap(self, date):
+        # دیتابیس تازه (مثلاً روی یک runner جدید) یک بار از روی گوگل شیت پر می‌شود
+        if self.mirror is None:
+            return
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM messages WHERE date = ? LIMIT 1", (date,)).fetchone()
+        if exists:
+            return
+        try:
+            rows = [row for row in self.mirror.fetch() if row[1] == date and not str(row[0]).startswith(BOOKKEEPING_KEYS)]
+        except Exception as e:
+            logging.warning("⚠️ خواندن وضعیت از گوگل شیت ناموفق بود: %s", e)
+            return
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+        logging.info("📥 %d ردیف از گوگل شیت به دیتابیس محلی منتقل شد.", len(rows))
+
+    def rows_for(self, emoji, date):
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT emoji, date, part, message_id, text FROM messages WHERE emoji = ? AND date = ? ORDER BY part",
+                (emoji, date)
+            )
+            return [list(row) for row in cursor]
+
+    def all_rows(self):
+        with self.lock:
+            cursor = self.conn.execute("SELECT emoji, date, part, message_id, text FROM messages ORDER BY date, emoji, part")
+            return [list(row) for row in cursor]
+
+    def replace(self, emoji, date, rows):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE emoji = ? AND date = ?", (emoji, date))
+            self.conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+            self.dirty = True
+
+    def get_value(self, key, date):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM bookkeeping WHERE key = ? AND date = ?", (key, date)).fetchone()
+        return row[0] if row else None
+
+    def set_value(self, key, date, value):
+        # فقط در دیتابیس محلی است و نسخه گوگل شیت را کثیف نمی‌کند
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO bookkeeping VALUES (?, ?, ?)", (key, date, value))
+
+    def prune(self, keep_date):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM bookkeeping WHERE date != ?", (keep_date,))
+            deleted = self.conn.execute("DELETE FROM messages WHERE date != ?", (keep_date,)).rowcount
+            if deleted:
+                logging.info("🧹 %d ردیف قدیمی از دیتابیس حذف شد.", deleted)
+                self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return False
+        self.dirty = False
+        if self.mirror is not None:
+            self.mirror.push(self.all_rows())
+        return True
+
+    def close(self):
+        if self.mirror is not None:
+            self.mirror.wait()
+        self.conn.close()
+
+def open_message_store(today):
+    if STATE_BACKEND == "sheets":
+        store = SheetMessageStore(get_sheet()).load()
+        check_and_create_headers(store)
+        return store
+    mirror = SheetMirror(get_sheet) if SHEET_MIRROR and SPREADSHEET_ID else None
+    store = SQLiteMessageStore(STATE_DB_PATH, mirror=mirror)
+    store.bootstrap(today)
+    return store
+
+def check_and_create_headers(store):
+    if store.header != SHEET_HEADERS:
+        store.dirty = True
         logging.info("✅ هدرها اضافه شدند.")
     else:
         logging.info("🔄 هدرها قبلاً موجود هستند.")
 
-def load_sheet_data(sheet):
-    records = sheet.get_all_records()
-    data = {}
-    for row in records:
-        emoji = row.get("emoji")
-        date = row.get("date")
-        part = row.get("part")
-        if emoji and date:
-            data.setdefault((emoji, date), []).append({
-                "part": int(part),
-                "message_id": row.get("message_id"),
-                "text": row.get("text")
-            })
-    return data
-
-def update_sheet_data(sheet, emoji, messages):
-    today = JalaliDate.today().strftime("%Y-%m-%d")
-    records = sheet.get_all_records()
-    rows_to_delete = [i+2 for i, row in enumerate(records) if row.get("emoji") == emoji and row.get("date") == today]
-    for row_num in reversed(rows_to_delete):
-        sheet.delete_rows(row_num)
-    for part, (message_id, text) in enumerate(messages, 1):
-        sheet.append_row([emoji, today, part, message_id, text])
+def load_messages(store, emoji, date):
+    return [
+        {"part": int(part), "message_id": message_id, "text": text}
+        for _, _, part, message_id, text in store.rows_for(emoji, date)
+    ]
+
+def update_sheet_data(store, emoji, messages):
+    today = jalali_today().strftime("%Y-%m-%d")
+    rows = [[emoji, today, part, message_id, text] for part, (message_id, text) in enumerate(messages, 1)]
+    store.replace(emoji, today, rows)
 
-def send_telegram_message(message, bot_token, chat_id):
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    params = {
-        "chat_id": chat_id,
-        "text": escape_special_characters(message),
-        "parse_mode": "MarkdownV2"
-    }
-    response = requests.post(url, json=params)
-    if response.ok:
-        return response.json()["result"]["message_id"]
-    else:
-        logging.error("خطا در ارسال پیام: %s", response.text)
+class RunJournal:
+    # journal اجرای جاری به صورت JSON Lines؛ هر خط یک رویداد است: شروع، snapshot کاتالوگ،
+    # برنامه‌ریزی یک عملیات تلگرام، نتیجه آن و پایان موفق. فایل فقط اضافه می‌شود تا
+    # اگر اجرا وسط کار قطع شد، همه عملیات تمام‌شده تا آن لحظه در آن باقی بماند
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.next_id = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def load(self):
+        # وضعیت آخرین اجرا: {date, complete, snapshot, operations}؛ خط ناقص آخر نادیده گرفته می‌شود
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        state = {"date": None, "complete": False, "snapshot": {}, "operations": {}}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                kind = event.pop("event", None)
+                if kind == "begin":
+                    state["date"] = event["date"]
+                elif kind == "snapshot":
+                    state["snapshot"][event.pop("page")] = event
+                elif kind == "plan":
+                    event["status"] = "planned"
+                    state["operations"][event["id"]] = event
+                elif kind == "finish" and event["id"] in state["operations"]:
+                    state["operations"][event["id"]].update(event)
+                elif kind == "complete":
+                    state["complete"] = True
+        state["operations"] = list(state["operations"].values())
+        return state
+
+    def write(self, event):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def begin(self, date):
+        if not self.enabled:
+            return
+        self.close()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.next_id = 0
+        self.write({"event": "begin", "date": date, "started_at": time.time()})
+
+    def snapshot(self, page, brands, models, cards=None, scraped_at=None):
+        self.write({"event": "snapshot", "page": page, "scraped_at": scraped_at or time.time(),
+                    "brands": brands, "models": models, "cards": cards})
+
+    def plan(self, chat_id, key, part, kind, message_id, text):
+        if self.file is None:
+            return None
+        with self.lock:
+            op_id = self.next_id
+            self.next_id += 1
+        self.write({"event": "plan", "id": op_id, "chat_id": chat_id, "key": key, "part": part,
+                    "kind": kind, "message_id": message_id, "text": text})
+        return op_id
+
+    def finish(self, op_id, ok, message_id=None):
+        if op_id is not None:
+            status = "done" if ok else "unknown" if message_id == UNKNOWN_MESSAGE_ID else "failed"
+            self.write({"event": "finish", "id": op_id, "status": status, "result_message_id": message_id})
+
+    def complete(self):
+        self.write({"event": "complete", "finished_at": time.time()})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+journal = RunJournal()
+
+def reconcile_journal(store, state, date):
+    # عملیاتی که در اجرای قطع‌شده انجام شده‌اند در store ثبت می‌شوند تا store با چت یکی شود؛
+    # عملیات باقی‌مانده در اجرای جاری دوباره از مقایسه با store به دست می‌آیند. ارسال‌هایی که
+    # شاید رسیده باشند با UNKNOWN_MESSAGE_ID ثبت می‌شوند تا دوباره فرستاده نشوند
+    operations = [op for op in state["operations"] if op.get("status") in ("done", "unknown")]
+    for op in state["operations"]:
+        if op.get("status") in ("planned", "unknown") and op["kind"] == "send":
+            logging.warning("⚠️ معلوم نیست پیام %s (پارت %d) در اجرای قبلی ارسال شده باشد.", op["key"], op["part"])
+    keys = []
+    for op in operations:
+        if op["key"] not in keys:
+            keys.append(op["key"])
+    for key in keys:
+        rows = {row[2]: row for row in store.rows_for(key, date)}
+        for op in operations:
+            if op["key"] != key:
+                continue
+            if op["kind"] == "delete":
+                if op["part"] in rows and rows[op["part"]][3] == op["message_id"]:
+                    del rows[op["part"]]
+            else:
+                message_id = op["result_message_id"] if op["kind"] == "send" else op["message_id"]
+                rows[op["part"]] = [key, date, op["part"], message_id, op["text"]]
+        store.replace(key, date, [rows[part] for part in sorted(rows)])
+    if operations:
+        logging.info("🧾 %d عملیات انجام‌شده از اجرای ناتمام قبلی در وضعیت ثبت شد.", len(operations))
+
+def as_toman(value):
+    return None if value is None else int(round(value))
+
+class PriceHistory:
+    # تاریخچه قیمت هر رنگ از هر مدل؛ هر کالا یک بار در جدول items ثبت می‌شود و در history فقط
+    # تغییرات (قیمت جدید، ناموجود شدن با قیمت NULL یا برگشتن) با کلید (item_id, ts) ذخیره می‌شوند.
+    # آخرین وضعیت هر کالا در latest نگه داشته می‌شود تا مقایسه هر اجرا به کل تاریخچه نیازی نداشته باشد
+    def __init__(self, path=PRICE_HISTORY_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def connect(self):
+        if self.conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self.conn:
+                self.conn.executescript(
+                    "CREATE TABLE IF NOT EXISTS items ("
+                    "id INTEGER PRIMARY KEY, category TEXT NOT NULL, brand TEXT NOT NULL, model TEXT NOT NULL, "
+                    "variant TEXT NOT NULL, UNIQUE (category, brand, model, variant));"
+                    "CREATE INDEX IF NOT EXISTS items_model ON items (model);"
+                    "CREATE TABLE IF NOT EXISTS latest ("
+                    "item_id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, price INTEGER, raw_price INTEGER);"
+                    "CREATE TABLE IF NOT EXISTS history ("
+                    "item_id INTEGER NOT NULL, ts INTEGER NOT NULL, price INTEGER, raw_price INTEGER, "
+                    "PRIMARY KEY (item_id, ts)) WITHOUT ROWID;"
+                    "CREATE INDEX IF NOT EXISTS history_ts ON history (ts);"
+                )
+        return self.conn
+
+    def record(self, products, ts=None):
+        # فقط کالاهایی که قیمتشان نسبت به آخرین وضعیت عوض شده ثبت می‌شوند. کالای غایب فقط در
+        # دسته‌هایی که در این اجرا محصول داشته‌اند ناموجود ثبت می‌شود تا شکست استخراج یک صفحه
+        # کل آن دسته را حذف‌شده نشان ندهد
+        if not self.enabled:
+            return 0
+        ts = int(ts if ts is not None else time.time())
+        current = {}
+        for product in products:
+            key = (product.category, product.brand, product.model, product.variant or "")
+            current.setdefault(key, (as_toman(product.price), as_toman(product.raw_price)))
+        categories = {key[0] for key in current}
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                ids = {tuple(row[1:]): row[0] for row in conn.execute("SELECT id, category, brand, model, variant FROM items")}
+                latest = {row[0]: row[1:] for row in conn.execute("SELECT item_id, price, raw_price FROM latest")}
+                changes = []
+                for key, prices in current.items():
+                    item_id = ids.get(key)
+                    if item_id is None:
+                        item_id = ids[key] = conn.execute("INSERT INTO items (category, brand, model, variant) VALUES (?, ?, ?, ?)", key).lastrowid
+                    if latest.get(item_id) != prices:
+                        changes.append((item_id, ts) + prices)
+                for key, item_id in ids.items():
+                    if key[0] in categories and key not in current and latest.get(item_id, (None, None)) != (None, None):
+                        changes.append((item_id, ts, None, None))
+                conn.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)", changes)
+                conn.executemany("INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?)", changes)
+        metrics.count("history.changes", len(changes))
+        return len(changes)
+
+    def deltas(self, model, since=None):
+        # تغییرات قیمت هر رنگ از مدل‌هایی که نامشان شامل model است، به ترتیب زمان، همراه با اختلاف با قیمت قبلی
+        with self.lock:
+            conn = self.connect()
+            items = conn.execute(
+                "SELECT id, category, brand, model, variant FROM items WHERE model LIKE ? ORDER BY brand, model, variant",
+                (f"%{model}%",)
+            ).fetchall()
+            result = []
+            for item_id, category, brand, item_model, variant in items:
+                previous = None
+                if since is not None:
+                    row = conn.execute(
+                        "SELECT price FROM history WHERE item_id = ? AND ts < ? ORDER BY ts DESC LIMIT 1", (item_id, int(since))
+                    ).fetchone()
+                    previous = row[0] if row else None
+                cursor = conn.execute(
+                    "SELECT ts, price FROM history WHERE item_id = ? AND ts >= ? ORDER BY ts", (item_id, int(since or 0))
+                )
+                for ts, price in cursor:
+                    delta = price - previous if price is not None and previous is not None else None
+                    result.append({"ts": ts, "category": category, "brand": brand, "model": item_model, "variant": variant,
+                                   "price": price, "previous": previous, "delta": delta})
+                    previous = price
+        return result
+
+    def movers(self, day=None, limit=None, include_availability=False):
+        # کالاهایی که قیمت پایان روز (به وقت تهران) با قیمت ابتدای روز فرق دارد، به ترتیب بزرگی تغییر؛
+        # با include_availability کالاهای تازه موجود یا ناموجود شده هم برگردانده می‌شوند
+        day = day or datetime.now(TEHRAN_TZ).date()
+        start = int(datetime(day.year, day.month, day.day, tzinfo=TEHRAN_TZ).timestamp())
+        end = start + 86400
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT i.category, i.brand, i.model, i.variant, c.changes, "
+                "(SELECT price FROM history h WHERE h.item_id = c.item_id AND h.ts < ? ORDER BY h.ts DESC LIMIT 1), "
+                "(SELECT price FROM history h WHERE h.item_id = c.item_id AND h.ts < ? ORDER BY h.ts DESC LIMIT 1) "
+                "FROM (SELECT item_id, COUNT(*) AS changes FROM history WHERE ts >= ? AND ts < ? GROUP BY item_id) c "
+                "JOIN items i ON i.id = c.item_id",
+                (start, end, start, end)
+            ).fetchall()
+        result = []
+        for category, brand, model, variant, changes, opening, closing in rows:
+            delta = closing - opening if opening is not None and closing is not None else None
+            if opening == closing or (delta is None and not include_availability):
+                continue
+            result.append({"category": category, "brand": brand, "model": model, "variant": variant, "changes": changes,
+                           "opening": opening, "closing": closing, "delta": delta,
+                           "percent": round(delta * 100.0 / opening, 2) if delta is not None and opening else None})
+        result.sort(key=lambda row: (row["delta"] is None, -abs(row["delta"] or 0)))
+        return result[:limit] if limit else result
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+price_history = PriceHistory()
+
+class RateLimiter:
+    # برای هر چت فاصله زمانی حداقلی بین درخواست‌ها را رعایت می‌کند
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, key):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(key, 0.0))
+            self.next_slot[key] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, key, seconds):
+        with self.lock:
+            self.next_slot[key] = max(self.next_slot.get(key, 0.0), time.monotonic() + seconds)
+
+# تکرار این متدها پس از رسیدن درخواست به تلگرام پیام تکراری در کانال می‌سازد؛ فقط وقتی
+# دوباره فرستاده می‌شوند که اتصال اصلاً برقرار نشده یا تلگرام با 429 رد کرده باشد
+NON_IDEMPOTENT_METHODS = frozenset({"sendMessage"})
+# نتیجه call وقتی درخواست غیرتکرارپذیر شاید به تلگرام رسیده باشد (timeout خواندن یا خطای 5xx)
+MAYBE_DELIVERED = object()
+# شناسه‌ای که به جای پیام شاید ارسال‌شده ذخیره می‌شود؛ شناسه‌های تلگرام از ۱ شروع می‌شوند
+UNKNOWN_MESSAGE_ID = 0
+
+def is_connect_error(error):
+    requests = lazy_import("requests")
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", None)
+    return isinstance(reason, lazy_import("urllib3.exceptions").NewConnectionError)
+
+class TelegramClient:
+    def __init__(self, bot_token, rate_per_chat=TELEGRAM_CHAT_RATE, max_retries=TELEGRAM_MAX_RETRIES):
+        self.base_url = f"https://api.telegram.org/bot{bot_token}/"
+        requests = lazy_import("requests")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(4, TELEGRAM_WORKERS * 2))
+        self.session.mount("https://", adapter)
+        self.limiter = RateLimiter(rate_per_chat)
+        self.max_retries = max_retries
+
+    def call(self, method, params):
+        chat_id = params.get("chat_id")
+        retry_safe = method not in NON_IDEMPOTENT_METHODS
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.count("telegram.retries")
+            with metrics.span("telegram.rate_limit_wait"):
+                self.limiter.wait(chat_id)
+            metrics.count(f"telegram.calls.{method}")
+            try:
+                with metrics.span(f"telegram.{method}"):
+                    response = self.session.post(self.base_url + method, json=params, timeout=HTTP_TIMEOUT)
+            except lazy_import("requests").RequestException as e:
+                logging.warning("⚠️ خطای شبکه در %s (تلاش %d): %s", method, attempt + 1, e)
+                metrics.count("telegram.network_errors")
+                response = None
+                if not retry_safe and not is_connect_error(e):
+                    # ممکن است پیام رسیده و فقط پاسخ گم شده باشد
+                    return MAYBE_DELIVERED
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            if metrics.enabled:
+                metrics.count("telegram.bytes_sent", len(response.request.body or b""))
+                metrics.count("telegram.bytes_received", len(response.content))
+            if response.status_code == 429:
+                metrics.count("telegram.rate_limited")
+                try:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                except ValueError:
+                    retry_after = 1
+                logging.warning("⏳ محدودیت تلگرام در %s؛ %s ثانیه صبر می‌شود.", method, retry_after)
+                self.limiter.pause(chat_id, retry_after)
+                continue
+            if response.status_code >= 500:
+                metrics.count("telegram.server_errors")
+                logging.warning("⚠️ خطای %d تلگرام در %s (تلاش %d).", response.status_code, method, attempt + 1)
+                if not retry_safe:
+                    return MAYBE_DELIVERED
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            return response
+        return response
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        params = {"chat_id": chat_id, "text": text, "parse_mode": "MarkdownV2"}
+        if reply_markup is not None:
+            params["reply_markup"] = json.dumps(reply_markup)
+        response = self.call("sendMessage", params)
+        if response is MAYBE_DELIVERED:
+            logging.error("⚠️ معلوم نیست پیام ارسال شده باشد؛ به صورت خودکار دوباره فرستاده نمی‌شود.")
+            return UNKNOWN_MESSAGE_ID
+        if response is not None and response.ok:
+            return response.json()["result"]["message_id"]
+        logging.error("خطا در ارسال پیام: %s", response.text if response is not None else "بدون پاسخ")
         return None
 
+    def edit_message(self, chat_id, message_id, text, reply_markup=None):
+        params = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "MarkdownV2"}
+        if reply_markup is not None:
+            params["reply_markup"] = json.dumps(reply_markup)
+        response = self.call("editMessageText", params)
+        if response is None:
+            return False
+        # اگر متن پیام از قبل همین بوده، ویرایش موفق حساب می‌شود
+        return response.ok or "message is not modified" in response.text
+
+    def delete_message(self, chat_id, message_id):
+        response = self.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+        return response is not None and response.ok
+
+_telegram_clients = {}
+_telegram_clients_lock = threading.Lock()
+
+def get_telegram_client(bot_token):
+    with _telegram_clients_lock:
+        client = _telegram_clients.get(bot_token)
+        if client is None:
+            client = _telegram_clients[bot_token] = TelegramClient(bot_token)
+        return client
+
+def send_telegram_message(message, bot_token, chat_id):
+    return get_telegram_client(bot_token).send_message(chat_id, message.escaped)
+
 def edit_telegram_message(message_id, message, bot_token, chat_id):
-    url = f"https://api.telegram.org/bot{bot_token}/editMessageText"
-    params = {
-        "chat_id": chat_id,
-        "message_id": message_id,
-        "text": escape_special_characters(message),
-        "parse_mode": "MarkdownV2"
-    }
-    response = requests.post(url, json=params)
-    return response.ok
+    return get_telegram_client(bot_token).edit_message(chat_id, message_id, message.escaped)
 
 def delete_telegram_message(message_id, bot_token, chat_id):
-    url = f"https://api.telegram.org/bot{bot_token}/deleteMessage"
-    params = {
-        "chat_id": chat_id,
-        "message_id": message_id
-    }
-    response = requests.post(url, json=params)
-    return response.ok
+    return get_telegram_client(bot_token).delete_message(chat_id, message_id)
 
-def process_category_messages(emoji, messages, bot_token, chat_id, sheet, today):
-    sheet_data = load_sheet_data(sheet)
-    prev_msgs = sorted([row for row in sheet_data.get((emoji, today), [])], key=lambda x: x["part"])
+def edit_category_messages(emoji, messages, bot_token, chat_id, store, today):
+    # فقط ویرایش و حذف انجام می‌شود؛ پیام‌های جدید شناسه None می‌گیرند تا بعداً به ترتیب ارسال شوند
+    prev_msgs = load_messages(store, emoji, today)
     new_msgs = []
     should_send_final_message = False
     for i, msg in enumerate(messages):
-        if i < len(prev_msgs):
-            if prev_msgs[i]["text"] != msg:
+        if i < len(prev_msgs) and prev_msgs[i]["message_id"] == UNKNOWN_MESSAGE_ID:
+            # پیامی که شاید رسیده باشد نه ویرایش می‌شود و نه دوباره فرستاده می‌شود
+            logging.warning("⚠️ پارت %d از %s شاید ارسال شده باشد؛ بدون تغییر رها می‌شود.", i + 1, emoji)
+            message_id = UNKNOWN_MESSAGE_ID
+        elif i < len(prev_msgs):
+            if prev_msgs[i]["text"] != msg.text:
+                op = journal.plan(chat_id, emoji, i + 1, "edit", prev_msgs[i]["message_id"], msg.text)
                 ok = edit_telegram_message(prev_msgs[i]["message_id"], msg, bot_token, chat_id)
-                if not ok:
-                    message_id = send_telegram_message(msg, bot_token, chat_id)
-                    should_send_final_message = True
-                else:
-                    message_id = prev_msgs[i]["message_id"]
-                    should_send_final_message = True
+                journal.finish(op, ok)
+                message_id = prev_msgs[i]["message_id"] if ok else None
+                should_send_final_message = True
             else:
                 message_id = prev_msgs[i]["message_id"]
         else:
-            message_id = send_telegram_message(msg, bot_token, chat_id)
+            message_id = None
             should_send_final_message = True
-        new_msgs.append((message_id, msg))
+        new_msgs.append([message_id, msg])
     for j in range(len(messages), len(prev_msgs)):
-        delete_telegram_message(prev_msgs[j]["message_id"], bot_token, chat_id)
+        if prev_msgs[j]["message_id"] == UNKNOWN_MESSAGE_ID:
+            logging.warning("⚠️ پارت %d از %s شاید ارسال شده باشد و باید دستی حذف شود.", j + 1, emoji)
+            continue
+        op = journal.plan(chat_id, emoji, j + 1, "delete", prev_msgs[j]["message_id"], None)
+        journal.finish(op, delete_telegram_message(prev_msgs[j]["message_id"], bot_token, chat_id))
         should_send_final_message = True
-    update_sheet_data(sheet, emoji, new_msgs)
-    return [msg_id for msg_id, _ in new_msgs], should_send_final_message
-
-def update_final_message_in_sheet(sheet, message_id, text):
-    today = JalaliDate.today().strftime("%Y-%m-%d")
-    records = sheet.get_all_records()
-    found = False
-    for i, row in enumerate(records, start=2):
-        if row.get("emoji") == "FINAL" and row.get("date") == today:
-            sheet.update(values=[["FINAL", today, 1, message_id, text]], range_name=f"A{i}:E{i}")
-            found = True
-            break
-    if not found:
-        sheet.append_row(["FINAL", today, 1, message_id, text])
-
-def get_final_message_from_sheet(sheet):
-    today = JalaliDate.today().strftime("%Y-%m-%d")
-    records = sheet.get_all_records()
-    for row in records:
-        if row.get("emoji") == "FINAL" and row.get("date") == today:
-            return row.get("message_id"), row.get("text")
+    return new_msgs, should_send_final_message
+
+def send_pending_messages(new_msgs, bot_token, chat_id, key=None):
+    # همه ارسال‌های یک دسته پیش از شروع در journal ثبت می‌شوند
+    ops = {part: journal.plan(chat_id, key, part, "send", None, entry[1].text)
+           for part, entry in enumerate(new_msgs, 1) if entry[0] is None}
+    for part, entry in enumerate(new_msgs, 1):
+        if entry[0] is None:
+            entry[0] = send_telegram_message(entry[1], bot_token, chat_id)
+            journal.finish(ops[part], bool(entry[0]), entry[0])
+
+def edit_categories(category_messages, bot_token, chat_id, store, today, max_workers=TELEGRAM_WORKERS, suffix=""):
+    # ویرایش دسته‌ها مستقل از هم است و هم‌زمان انجام می‌شود. وضعیت هر دسته با کلید
+    # emoji + suffix ذخیره می‌شود تا هر چت وضعیت جداگانه داشته باشد. RateLimiter شروع
+    # درخواست‌های یک چت را با فاصله TELEGRAM_CHAT_RATE می‌چیند؛ پس در یک چت هم‌زمانی فقط
+    # زمان رفت‌وبرگشت درخواست‌ها را روی هم می‌اندازد و از سقف نرخ تند‌تر نمی‌شود
+    items = list(category_messages.items())
+    if not items:
+        return {}
+    workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda item: edit_category_messages(item[0] + suffix, item[1], bot_token, chat_id, store, today), items
+        ))
+    return dict(zip(category_messages, results))
+
+def send_categories(edited, bot_token, chat_id, store, suffix=""):
+    # پیام‌های جدید به ترتیب دسته‌ها فرستاده می‌شوند تا ترتیب پیام‌ها در کانال به هم نریزد
+    all_message_ids = {}
+    should_send_final_message = False
+    for emoji, (new_msgs, changed) in edited.items():
+        send_pending_messages(new_msgs, bot_token, chat_id, emoji + suffix)
+        update_sheet_data(store, emoji + suffix, [(message_id, msg.text) for message_id, msg in new_msgs])
+        all_message_ids[emoji] = [msg_id for msg_id, _ in new_msgs]
+        if changed:
+            should_send_final_message = True
+    return all_message_ids, should_send_final_message
+
+def compute_fingerprint(lines):
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def get_fingerprint(store, key, date):
+    return store.get_value(key, date)
+
+def set_fingerprint(store, key, date, value):
+    store.set_value(key, date, value)
+
+def update_final_message_in_sheet(store, message_id, text, key="FINAL"):
+    today = jalali_today().strftime("%Y-%m-%d")
+    store.replace(key, today, [[key, today, 1, message_id, text]])
+
+def get_final_message_from_sheet(store, key="FINAL"):
+    today = jalali_today().strftime("%Y-%m-%d")
+    for _, _, _, message_id, text in store.rows_for(key, today):
+        return message_id, text
     return None, None
 
-def send_or_edit_final_message(sheet, final_message, bot_token, chat_id, button_markup, should_send):
-    message_id, prev_text = get_final_message_from_sheet(sheet)
+def send_or_edit_final_message(store, final_message, bot_token, chat_id, button_markup, should_send, key="FINAL"):
+    message_id, prev_text = get_final_message_from_sheet(store, key)
     escaped_text = escape_special_characters(final_message)
+    client = get_telegram_client(bot_token)
+    if message_id == UNKNOWN_MESSAGE_ID:
+        logging.warning("⚠️ پیام نهایی امروز شاید ارسال شده باشد؛ دوباره فرستاده نمی‌شود.")
+        return None
     if message_id and prev_text == final_message and not should_send:
         logging.info("🔁 پیام نهایی تغییری نکرده است.")
         return message_id
     if message_id and (prev_text != final_message or should_send):
-        url = f"https://api.telegram.org/bot{bot_token}/editMessageText"
-        params = {
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "text": escaped_text,
-            "parse_mode": "MarkdownV2",
-            "reply_markup": json.dumps(button_markup)
-        }
-        response = requests.post(url, json=params)
-        if response.ok:
-            update_final_message_in_sheet(sheet, message_id, final_message)
+        op = journal.plan(chat_id, key, 1, "edit", message_id, final_message)
+        ok = client.edit_message(chat_id, message_id, escaped_text, reply_markup=button_markup)
+        journal.finish(op, ok)
+        if ok:
+            update_final_message_in_sheet(store, message_id, final_message, key)
             logging.info("✅ پیام نهایی ویرایش شد.")
             return message_id
         else:
             logging.warning("❌ خطا در ویرایش پیام نهایی، حذف پیام قبلی و ارسال پیام جدید.")
             # حذف پیام قبلی
-            del_url = f"https://api.telegram.org/bot{bot_token}/deleteMessage"
-            del_params = {
-                "chat_id": chat_id,
-                "message_id": message_id
-            }
-            del_response = requests.post(del_url, json=del_params)
-            if del_response.ok:
+            op = journal.plan(chat_id, key, 1, "delete", message_id, None)
+            ok = client.delete_message(chat_id, message_id)
+            journal.finish(op, ok)
+            if ok:
                 logging.info("✅ پیام نهایی قبلی حذف شد.")
             else:
-                logging.warning("❌ حذف پیام نهایی قبلی موفق نبود: %s", del_response.text)
+                logging.warning("❌ حذف پیام نهایی قبلی موفق نبود.")
     # ارسال پیام جدید
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    params = {
-        "chat_id": chat_id,
-        "text": escaped_text,
-        "parse_mode": "MarkdownV2",
-        "reply_markup": json.dumps(button_markup)
-    }
-    response = requests.post(url, json=params)
-    if response.ok:
-        message_id = response.json()["result"]["message_id"]
-        update_final_message_in_sheet(sheet, message_id, final_message)
+    op = journal.plan(chat_id, key, 1, "send", None, final_message)
+    message_id = client.send_message(chat_id, escaped_text, reply_markup=button_markup)
+    journal.finish(op, bool(message_id), message_id)
+    if message_id == UNKNOWN_MESSAGE_ID:
+        update_final_message_in_sheet(store, message_id, final_message, key)
+        return None
+    if message_id:
+        update_final_message_in_sheet(store, message_id, final_message, key)
         logging.info("✅ پیام نهایی ارسال شد.")
         return message_id
     else:
-        logging.error("❌ خطا در ارسال پیام نهایی: %s", response.text)
+        logging.error("❌ خطا در ارسال پیام نهایی.")
         return None
 
-def main():
-    try:
-        sheet = connect_to_sheet()
-        check_and_create_headers(sheet)
-        driver = get_driver()
-        if not driver:
-            logging.error("❌ نمی‌توان WebDriver را ایجاد کرد.")
-            return
-        categories_urls = {
-            "mobile": "https://hamrahtel.com/quick-checkout?category=mobile",
-            "laptop": "https://hamrahtel.com/quick-checkout?category=laptop",
-            "tablet": "https://hamrahtel.com/quick-checkout?category=tablet",
-            "console": "https://hamrahtel.com/quick-checkout?category=game-console"
-        }
-        valid_brands = ["Galaxy", "POCO", "Redmi", "iPhone", "Redtone", "VOCAL", "TCL", "NOKIA", "Honor", "Huawei", "GLX", "+Otel", "اینچی"]
-        brands, models = [], []
-        for name, url in categories_urls.items():
-            driver.get(url)
-            WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CLASS_NAME, 'mantine-Text-root')))
-            scroll_page(driver)
-            b, m = extract_product_data(driver, valid_brands)
-            brands.extend(b)
-            models.extend(m)
-        driver.quit()
-        if not brands:
-            logging.warning("❌ داده‌ای برای ارسال وجود ندارد!")
+DEFAULT_FINAL_MESSAGE = (
+    "✅ لیست گوشی و سایر کالاهای بالا بروز میباشد. ثبت خرید تا ساعت 10:30 شب انجام میشود و تحویل کالا ساعت 11:30 صبح روز بعد می باشد..\n\n"
+    "⭕️ حتما رسید واریز به ایدی تلگرام زیر ارسال شود .\n"
+    "🆔 @lhossein1\n\n"
+    "✅شماره تماس ثبت سفارش :\n"
+    "📞 09371111558\n"
+    "📞 09386373926\n"
+    "📞 09308529712\n"
+    "📞 028-3399-1417"
+)
+
+CATEGORY_BUTTON_LABELS = {
+    "🔵": "📱 لیست سامسونگ",
+    "🟡": "📱 لیست شیائومی",
+    "🍏": "📱 لیست آیفون",
+    "💻": "💻 لیست لپ‌تاپ",
+    "🟠": "📱 لیست تبلت",
+    "🎮": "🎮 کنسول بازی",
+    "🟣": "📱 لیست گوشیای متفرقه"
+}
+
+class PublishTarget:
+    # یک چت مقصد با فوتر، پیام نهایی و دسته‌های دلخواه. وضعیت چت اصلی (CHAT_ID) با همان
+    # کلیدهای قبلی و وضعیت بقیه چت‌ها با پسوند @chat_id در store نگه داشته می‌شود
+    __slots__ = ("chat_id", "categories", "footer", "final_message", "suffix")
+
+    def __init__(self, chat_id, categories=None, footer=DEFAULT_CATEGORY_FOOTER, final_message=DEFAULT_FINAL_MESSAGE, primary=False):
+        self.chat_id = str(chat_id)
+        self.categories = tuple(categories) if categories else None
+        self.footer = footer
+        self.final_message = final_message
+        self.suffix = "" if primary else f"@{self.chat_id}"
+
+    @classmethod
+    def from_config(cls, config):
+        footer = config.get("footer")
+        return cls(
+            config["chat_id"],
+            categories=config.get("categories"),
+            footer=DEFAULT_CATEGORY_FOOTER if footer is None else "\n\n" + footer.strip("\n"),
+            final_message=config.get("final_message") or DEFAULT_FINAL_MESSAGE,
+            primary=str(config["chat_id"]) == str(CHAT_ID)
+        )
+
+    def key(self, name):
+        return name + self.suffix
+
+    def wants(self, emoji):
+        return self.categories is None or emoji in self.categories
+
+    def fingerprint(self, product_lines):
+        # تنظیمات غیرپیش‌فرض مقصد هم در اثرانگشت می‌آید تا تغییر آن‌ها باعث انتشار دوباره شود
+        extra = []
+        if self.categories is not None:
+            extra.append("categories:" + ",".join(self.categories))
+        if self.footer != DEFAULT_CATEGORY_FOOTER:
+            extra.append("footer:" + self.footer)
+        if self.final_message != DEFAULT_FINAL_MESSAGE:
+            extra.append("final:" + self.final_message)
+        return compute_fingerprint(itertools.chain(product_lines, extra))
+
+    def message_url(self, message_id):
+        if self.chat_id.startswith("@"):
+            return f"https://t.me/{self.chat_id[1:]}/{message_id}"
+        return f"https://t.me/c/{self.chat_id.replace('-100', '')}/{message_id}"
+
+def load_target_configs(value=TELEGRAM_TARGETS):
+    # TELEGRAM_TARGETS یا خود JSON است یا مسیر یک فایل JSON؛ هر مقصد یک شیء با chat_id و
+    # کلیدهای اختیاری categories، footer و final_message است
+    value = value.strip()
+    if not value:
+        return []
+    if not value.startswith("["):
+        with open(value, encoding="utf-8") as f:
+            value = f.read()
+    return json.loads(value)
+
+def get_publish_targets():
+    configs = load_target_configs()
+    if not configs:
+        return [PublishTarget(CHAT_ID, primary=True)]
+    return [PublishTarget.from_config(config) for config in configs]
+
+class TargetPublisher:
+    # انتشار تدریجی دسته‌ها برای یک مقصد: ویرایش‌ها به محض آماده شدن هر دسته انجام می‌شوند،
+    # اما ارسال پیام‌های جدید تا قطعی شدن همه دسته‌های قبلی صبر می‌کند تا ترتیب کانال حفظ شود
+    def __init__(self, target, store, today):
+        self.target = target
+        self.store = store
+        self.today = today
+        self.pending = {}
+        self.message_ids = {}
+        self.fingerprints = {}
+        self.page_fingerprints = {}
+        self.unchanged_pages = set()
+        self.skipped = []
+        self.changed = False
+
+    def check_page(self, name, product_lines):
+        # صفحه‌ای که با آخرین اجرای موفق امروز یکی است؛ دسته‌هایی که همه صفحه‌هایشان این‌طورند رندر نمی‌شوند
+        fingerprint = self.target.fingerprint(product_lines)
+        self.page_fingerprints[name] = fingerprint
+        if get_fingerprint(self.store, self.target.key(f"{FINGERPRINT_KEY} page {name}"), self.today) == fingerprint:
+            self.unchanged_pages.add(name)
+
+    def unchanged(self, pages):
+        return pages <= self.unchanged_pages
+
+    def keep(self, emojis):
+        for emoji in emojis:
+            if self.target.wants(emoji):
+                prev_msgs = load_messages(self.store, self.target.key(emoji), self.today)
+                if prev_msgs:
+                    self.keep_messages(emoji, prev_msgs)
+
+    def keep_messages(self, emoji, prev_msgs):
+        self.message_ids[emoji] = [msg["message_id"] for msg in prev_msgs]
+        self.fingerprints.pop(emoji, None)
+        self.skipped.append(emoji)
+        if TIMESTAMP_REFRESH:
+            self.refresh_time(self.target.key(emoji), prev_msgs)
+
+    def refresh_time(self, key, prev_msgs):
+        # فقط ساعت سربرگ پارت اول دسته بدون تغییر به‌روز می‌شود؛ نه رندری لازم است و نه ویرایش پارت‌های دیگر
+        first = prev_msgs[0]
+        text = CATEGORY_TIME_PATTERN.sub(f"🕓 ساعت: {get_current_time()}", first["text"] or "", count=1)
+        if text == first["text"] or not first["message_id"]:
             return
-        processed_data = []
-        for i in range(len(brands)):
-            model_str = process_model(models[i])
-            processed_data.append(f"{model_str} {brands[i]}")
-        message_lines = [decorate_line(row) for row in processed_data]
-        categorized = categorize_messages(message_lines)
-        today = JalaliDate.today().strftime("%Y-%m-%d")
-        all_message_ids = {}
-        should_send_final_message = False
-        for emoji, lines in categorized.items():
-            if not lines:
+        op = journal.plan(self.target.chat_id, key, 1, "edit", first["message_id"], text)
+        ok = edit_telegram_message(first["message_id"], MessagePart(text), BOT_TOKEN, self.target.chat_id)
+        journal.finish(op, ok)
+        if ok:
+            self.store.replace(key, self.today, [[key, self.today, msg["part"], msg["message_id"], text if msg is first else msg["text"]]
+                                                 for msg in prev_msgs])
+
+    def publish(self, categories, render):
+        category_messages = {}
+        for emoji, groups in categories.items():
+            if not groups or not self.target.wants(emoji):
                 continue
-            message = prepare_final_message(emoji, lines, today)
-            message_parts = split_message_by_emoji_group(message)
+            key = self.target.key(emoji)
+            prev_msgs = load_messages(self.store, key, self.today)
+            if CATEGORY_FINGERPRINTS:
+                fingerprint = self.target.fingerprint(product.fingerprint_line() for group in groups for product in group)
+                if prev_msgs and get_fingerprint(self.store, self.target.key(f"{FINGERPRINT_KEY} {emoji}"), self.today) == fingerprint:
+                    self.keep_messages(emoji, prev_msgs)
+                    continue
+                self.fingerprints[emoji] = fingerprint
+            previous_parts = [msg["text"] for msg in prev_msgs]
+            with metrics.span("stage.split"):
+                message_parts = split_blocks(render(emoji, self.target.footer), previous_parts=previous_parts)
             current_time = get_current_time()
             for idx in range(1, len(message_parts)):
-                message_parts[idx] = f"⏰ {current_time}\n" + message_parts[idx]
-            message_ids, changed = process_category_messages(emoji, message_parts, BOT_TOKEN, CHAT_ID, sheet, today)
-            all_message_ids[emoji] = message_ids
-            if changed:
-                should_send_final_message = True
-        final_message = (
-            "✅ لیست گوشی و سایر کالاهای بالا بروز میباشد. ثبت خرید تا ساعت 10:30 شب انجام میشود و تحویل کالا ساعت 11:30 صبح روز بعد می باشد..\n\n"
-            "⭕️ حتما رسید واریز به ایدی تلگرام زیر ارسال شود .\n"
-            "🆔 @lhossein1\n\n"
-            "✅شماره تماس ثبت سفارش :\n"
-            "📞 09371111558\n"
-            "📞 09386373926\n"
-            "📞 09308529712\n"
-            "📞 028-3399-1417"
-        )
+                message_parts[idx] = message_parts[idx].prefixed(f"⏰ {current_time}\n")
+            category_messages[emoji] = reuse_unchanged_parts(message_parts, previous_parts)
+        metrics.count("catalog.categories_rendered", len(category_messages))
+        self.pending.update(edit_categories(
+            category_messages, BOT_TOKEN, self.target.chat_id, self.store, self.today, suffix=self.target.suffix
+        ))
+
+    def flush(self, settled):
+        # ارسال‌ها تا اولین دسته‌ای که هنوز قطعی نشده پیش می‌روند
+        ready = {}
+        for emoji in CATEGORY_EMOJIS:
+            if emoji not in settled:
+                break
+            if emoji in self.pending:
+                ready[emoji] = self.pending.pop(emoji)
+        message_ids, changed = send_categories(ready, BOT_TOKEN, self.target.chat_id, self.store, suffix=self.target.suffix)
+        self.message_ids.update(message_ids)
+        self.changed = self.changed or changed
+
+    def finish(self, catalog_fingerprint):
+        self.flush(CATEGORY_EMOJIS)
+        for emoji, fingerprint in self.fingerprints.items():
+            if all(self.message_ids.get(emoji, [None])):
+                set_fingerprint(self.store, self.target.key(f"{FINGERPRINT_KEY} {emoji}"), self.today, fingerprint)
+        metrics.count("catalog.categories_skipped", len(self.skipped))
+        if self.skipped:
+            logging.info("⏭️ دسته‌های بدون تغییر در %s: %s", self.target.chat_id, " ".join(self.skipped))
+        if not self.changed and get_fingerprint(self.store, self.target.key(FINGERPRINT_KEY), self.today) == catalog_fingerprint:
+            self.save_page_fingerprints()
+            return None
+        all_message_ids = {emoji: self.message_ids[emoji] for emoji in CATEGORY_EMOJIS if emoji in self.message_ids}
         button_markup = {"inline_keyboard": []}
-        emoji_labels = {
-            "🔵": "📱 لیست سامسونگ",
-            "🟡": "📱 لیست شیائومی",
-            "🍏": "📱 لیست آیفون",
-            "💻": "💻 لیست لپ‌تاپ",
-            "🟠": "📱 لیست تبلت",
-            "🎮": "🎮 کنسول بازی",
-            "🟣": "📱 لیست گوشیای متفرقه"
-        }
         for emoji, msg_ids in all_message_ids.items():
             for msg_id in msg_ids:
                 if msg_id:
                     button_markup["inline_keyboard"].append([
-                        {"text": emoji_labels.get(emoji, emoji), "url": f"https://t.me/c/{CHAT_ID.replace('-100', '')}/{msg_id}"}
+                        {"text": CATEGORY_BUTTON_LABELS.get(emoji, emoji), "url": self.target.message_url(msg_id)}
                     ])
-        send_or_edit_final_message(sheet, final_message, BOT_TOKEN, CHAT_ID, button_markup, should_send_final_message)
+        with metrics.span("stage.final_message"):
+            final_message_id = send_or_edit_final_message(
+                self.store, self.target.final_message, BOT_TOKEN, self.target.chat_id, button_markup, self.changed,
+                key=self.target.key("FINAL")
+            )
+        if final_message_id and all(all(msg_ids) for msg_ids in all_message_ids.values()):
+            set_fingerprint(self.store, self.target.key(FINGERPRINT_KEY), self.today, catalog_fingerprint)
+            self.save_page_fingerprints()
+            return True
+        return False
+
+    def save_page_fingerprints(self):
+        for name, fingerprint in self.page_fingerprints.items():
+            if name not in self.unchanged_pages:
+                set_fingerprint(self.store, self.target.key(f"{FINGERPRINT_KEY} page {name}"), self.today, fingerprint)
+
+# صفحه‌ای که هر دسته به آن تعلق دارد؛ دسته وقتی منتشر می‌شود که صفحه‌های آن تمام شده باشند
+CATEGORY_OWNERS = {
+    "mobile": ("🔵", "🟡", "🍏", "🟣"),
+    "laptop": ("💻",),
+    "tablet": ("🟠",),
+    "console": ("🎮",)
+}
+
+def expected_card_counts(store, today, page_names):
+    # تعداد کارت‌های آخرین استخراج امروز هر صفحه؛ مبنای پذیرش HTML در اسکرپر HTTP
+    counts = {}
+    for name in page_names:
+        value = get_fingerprint(store, f"{CARDS_KEY} {name}", today)
+        if value and str(value).isdigit():
+            counts[name] = int(value)
+    return counts
+
+def category_sources(store, today):
+    # علاوه بر صفحه صاحب، صفحه‌هایی که در اجرای قبلی امروز محصولی به دسته داده‌اند هم منتظر می‌مانند
+    sources = {emoji: set() for emoji in CATEGORY_EMOJIS}
+    for page, emojis in CATEGORY_OWNERS.items():
+        for emoji in emojis:
+            sources[emoji].add(page)
+    for emoji in CATEGORY_EMOJIS:
+        previous = get_fingerprint(store, f"{SOURCES_KEY} {emoji}", today)
+        if previous:
+            sources[emoji].update(previous.split(","))
+    return sources
+
+def make_renderer(categorized, today):
+    # هر دسته برای هر فوتر فقط یک بار رندر می‌شود و بین همه مقصدها مشترک است
+    rendered = {}
+    lock = threading.Lock()
+
+    def render(emoji, footer):
+        with lock:
+            if (emoji, footer) not in rendered:
+                with metrics.span("stage.render"):
+                    rendered[emoji, footer] = render_category_blocks(emoji, categorized[emoji], today, footer)
+            return rendered[emoji, footer]
+    return render
+
+def publish_stream(pages, page_names, targets, store, today):
+    # مصرف‌کننده: هر صفحه به محض رسیدن ساخته و قیمت‌گذاری می‌شود و دسته‌هایی که همه صفحه‌هایشان
+    # رسیده‌اند منتشر می‌شوند. محصولی که بعد از انتشار دسته‌اش از صفحه دیگری برسد دسته را
+    # برای انتشار دوباره در پایان علامت می‌زند؛ پیام نهایی پس از همه صفحه‌ها فرستاده می‌شود
+    page_index = {name: index for index, name in enumerate(page_names)}
+    sources = category_sources(store, today)
+    contributors = {emoji: set() for emoji in CATEGORY_EMOJIS}
+    page_products = {}
+    card_counts = {}
+    previous_counts = expected_card_counts(store, today, page_names)
+    published = set()
+    dirty = set()
+    publishers = [TargetPublisher(target, store, today) for target in targets]
+
+    def catalog():
+        return [product for name in page_names for product in page_products.get(name, [])]
+
+    def run(executor, method, *args):
+        def call(publisher):
+            try:
+                getattr(publisher, method)(*args)
+                return True
+            except Exception as e:
+                logging.error(f"❌ خطا در انتشار برای چت {publisher.target.chat_id}: {e}")
+                return False
+        return list(executor.map(call, publishers))
+
+    with ThreadPoolExecutor(max_workers=len(publishers)) as executor:
+        last_scraped = None
+        for name, brands, models, cards, scraped_at in pages:
+            last_scraped = max(scraped_at, last_scraped or scraped_at)
+            journal.snapshot(name, brands, models, cards, scraped_at)
+            with metrics.span("stage.build"):
+                products = build_products(brands, models, group_base=page_index[name] << 20, cards=cards)
+            page_products[name] = products
+            product_lines = [product.fingerprint_line() for product in products]
+            for publisher in publishers:
+                publisher.check_page(name, product_lines)
+            if cards:
+                card_counts[name] = len(set(cards))
+                previous = previous_counts.get(name)
+                if previous and card_counts[name] < previous * CARD_DROP_WARN_RATIO:
+                    # احتمالاً بارگذاری تنبل صفحه پیش از رسیدن همه کارت‌ها تمام شده است
+                    metrics.count("catalog.card_drops")
+                    logging.warning("⚠️ تعداد کارت‌های صفحه %s از %d به %d افتاد؛ ممکن است کاتالوگ ناقص استخراج شده باشد.",
+                                    name, previous, card_counts[name])
+            for product in products:
+                contributors[product.category].add(name)
+            dirty |= {product.category for product in products} & published
+            settled = {emoji for emoji in CATEGORY_EMOJIS if sources[emoji] <= page_products.keys()}
+            ready = settled - published
+            logging.info("🧩 صفحه %s رسید (%d محصول)؛ دسته‌های آماده: %s", name, len(products), " ".join(emoji for emoji in CATEGORY_EMOJIS if emoji in ready) or "-")
+            if ready:
+                # دسته‌ای که همه صفحه‌های منبعش برای همه مقصدها بدون تغییرند نه دسته‌بندی می‌شود نه رندر
+                unchanged = {emoji for emoji in ready
+                             if all(publisher.unchanged(sources[emoji] | contributors[emoji]) for publisher in publishers)}
+                with metrics.span("stage.publish"):
+                    if unchanged:
+                        run(executor, "keep", unchanged)
+                    if ready - unchanged:
+                        categorized = categorize_products(catalog())
+                        render = make_renderer(categorized, today)
+                        run(executor, "publish", {emoji: categorized[emoji] for emoji in CATEGORY_EMOJIS if emoji in ready - unchanged}, render)
+                    run(executor, "flush", settled)
+                published |= ready
+        products = catalog()
+        metrics.count("catalog.products", len(products))
+        if not products:
+            logging.warning("❌ داده‌ای برای ارسال وجود ندارد!")
+            return "empty"
+        try:
+            with metrics.span("history.record"):
+                changes = price_history.record(products, last_scraped)
+            if changes:
+                logging.info("📒 %d تغییر قیمت در تاریخچه ثبت شد.", changes)
+        except sqlite3.Error as e:
+            logging.warning("⚠️ ثبت تاریخچه قیمت ناموفق بود: %s", e)
+        for emoji in CATEGORY_EMOJIS:
+            value = ",".join(sorted(contributors[emoji]))
+            if value and get_fingerprint(store, f"{SOURCES_KEY} {emoji}", today) != value:
+                set_fingerprint(store, f"{SOURCES_KEY} {emoji}", today, value)
+        for name, count in card_counts.items():
+            if str(get_fingerprint(store, f"{CARDS_KEY} {name}", today)) != str(count):
+                set_fingerprint(store, f"{CARDS_KEY} {name}", today, str(count))
+        product_lines = [product.fingerprint_line() for product in products]
+        with metrics.span("stage.publish"):
+            run(executor, "flush", CATEGORY_EMOJIS)
+            remaining = (set(CATEGORY_EMOJIS) - published) | dirty
+            if dirty:
+                logging.info("🔁 دسته‌های %s محصول دیرهنگام داشتند و دوباره منتشر می‌شوند.", " ".join(emoji for emoji in CATEGORY_EMOJIS if emoji in dirty))
+            if remaining:
+                categorized = categorize_products(products)
+                render = make_renderer(categorized, today)
+                run(executor, "publish", {emoji: categorized[emoji] for emoji in CATEGORY_EMOJIS if emoji in remaining}, render)
+
+            def finish(publisher):
+                try:
+                    return publisher.finish(publisher.target.fingerprint(product_lines))
+                except Exception as e:
+                    logging.error(f"❌ خطا در انتشار برای چت {publisher.target.chat_id}: {e}")
+                    return False
+            results = list(executor.map(finish, publishers))
+    if all(result is None for result in results):
+        logging.info("⏭️ کاتالوگ از اجرای قبلی تغییری نکرده است.")
+        return "unchanged"
+    return "ok" if all(result is not False for result in results) else "partial"
+
+def resume_from_journal(store, today, page_names):
+    # اگر اجرای قبلی امروز ناتمام مانده، نتیجه عملیات انجام‌شده‌اش در store ثبت و
+    # snapshot صفحه‌های آن (اگر همه به اندازه کافی تازه باشند) به جای استخراج دوباره برگردانده می‌شود
+    try:
+        state = journal.load()
+    except OSError as e:
+        logging.warning("⚠️ خواندن journal اجرای قبلی ناموفق بود: %s", e)
+        return None
+    if not state or state["complete"] or state["date"] != today:
+        return None
+    logging.info("🧾 اجرای قبلی ناتمام مانده بود؛ وضعیت آن بازیابی می‌شود.")
+    reconcile_journal(store, state, today)
+    snapshot = state["snapshot"]
+    if not all(name in snapshot for name in page_names):
+        return None
+    age = time.time() - min(snapshot[name]["scraped_at"] for name in page_names)
+    if age > JOURNAL_SNAPSHOT_MAX_AGE:
+        return None
+    logging.info("♻️ کاتالوگ استخراج‌شده %.0f ثانیه پیش دوباره استفاده می‌شود.", age)
+    return [(name, snapshot[name]["brands"], snapshot[name]["models"], snapshot[name].get("cards"), snapshot[name]["scraped_at"])
+            for name in page_names]
+
+def main(store=None, driver_pool=None):
+    own_store = store is None
+    status = "error"
+    metrics.reset()
+    try:
+        if own_store:
+            with metrics.span("stage.open_store"):
+                store = open_message_store(jalali_today().strftime("%Y-%m-%d"))
+        categories_urls = {
+            "mobile": "https://hamrahtel.com/quick-checkout?category=mobile",
+            "laptop": "https://hamrahtel.com/quick-checkout?category=laptop",
+            "tablet": "https://hamrahtel.com/quick-checkout?category=tablet",
+            "console": "https://hamrahtel.com/quick-checkout?category=game-console"
+        }
+        valid_brands = ["Galaxy", "POCO", "Redmi", "iPhone", "Redtone", "VOCAL", "TCL", "NOKIA", "Honor", "Huawei", "GLX", "+Otel", "اینچی"]
+        today = jalali_today().strftime("%Y-%m-%d")
+        snapshot = resume_from_journal(store, today, list(categories_urls))
+        store.prune(today)
+        journal.begin(today)
+        if snapshot:
+            pages = iter(snapshot)
+            metrics.count("journal.snapshot_reused")
+        else:
+            pages = stream_catalog(categories_urls, valid_brands, driver_pool=driver_pool,
+                                   expected_cards=expected_card_counts(store, today, list(categories_urls)))
+        try:
+            with metrics.span("stage.stream"):
+                status = publish_stream(pages, list(categories_urls), get_publish_targets(), store, today)
+        finally:
+            if not snapshot:
+                pages.close()
+        if status in ("ok", "unchanged"):
+            journal.complete()
     except Exception as e:
         logging.error(f"❌ خطا: {e}")
+    finally:
+        if store is not None:
+            try:
+                with metrics.span("stage.flush"):
+                    store.flush()
+                    if own_store:
+                        store.close()
+            except Exception as e:
+                logging.error(f"❌ خطا در ذخیره وضعیت پیام‌ها: {e}")
+        journal.close()
+        price_history.close()
+        log_startup_timings()
+        try:
+            if metrics.write(RUN_REPORT_DIR, status):
+                logging.info("📈 گزارش اجرا در %s نوشته شد.", RUN_REPORT_DIR)
+        except OSError as e:
+            logging.warning("⚠️ نوشتن گزارش اجرا ناموفق بود: %s", e)
+
+def run_daemon(interval=DAEMON_INTERVAL):
+    # مرورگرها، اتصال شیت و نشست‌های HTTP بین اجراها گرم می‌مانند
+    driver_pool = DriverPool(SCRAPE_WORKERS, profile_dir=BROWSER_PROFILE_DIR)
+    store = None
+    logging.info("🚀 حالت daemon با فاصله %.0f ثانیه شروع شد.", interval)
+    try:
+        while True:
+            started = time.monotonic()
+            if within_run_window():
+                if store is None and STATE_BACKEND != "sheets":
+                    try:
+                        store = open_message_store(jalali_today().strftime("%Y-%m-%d"))
+                    except Exception as e:
+                        logging.error(f"❌ خطا در باز کردن وضعیت پیام‌ها: {e}")
+                main(store=store, driver_pool=driver_pool)
+                logging.info("⏱️ اجرای این دوره %.1f ثانیه طول کشید.", time.monotonic() - started)
+            else:
+                # بیرون از بازه مجاز مرورگرها بسته می‌شوند تا منابع آزاد شوند
+                driver_pool.close()
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logging.info("🛑 حالت daemon متوقف شد.")
+    finally:
+        driver_pool.close()
+        if store is not None:
+            store.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="اجرای دائمی با زمان‌بند داخلی")
+    parser.add_argument("--interval", type=float, default=DAEMON_INTERVAL, help="فاصله بین اجراها (ثانیه)")
+    parser.add_argument("--check-window", action="store_true", help="فقط بررسی بازه مجاز اجرا؛ کد خروج ۰ یعنی داخل بازه")
+    parser.add_argument("--movers", nargs="?", const="today", metavar="YYYY-MM-DD", help="نمایش کالاهایی که قیمتشان در یک روز تغییر کرده است")
+    parser.add_argument("--price-history", metavar="MODEL", help="نمایش تاریخچه تغییرات قیمت یک مدل")
+    return parser.parse_args(argv)
+
+def format_toman(value):
+    return "ناموجود" if value is None else f"{value:,}"
+
+def print_price_report(args, history=None):
+    history = history or price_history
+    if args.movers:
+        day = None if args.movers == "today" else datetime.strptime(args.movers, "%Y-%m-%d").date()
+        for row in history.movers(day, include_availability=True):
+            change = f"{row['delta']:+,} ({row['percent']:+.2f}%)" if row["percent"] is not None else "-"
+            print(f"{row['category']} {row['model']} {row['brand']} | {row['variant']}: "
+                  f"{format_toman(row['opening'])} → {format_toman(row['closing'])} {change} [{row['changes']}]")
+    if args.price_history:
+        for row in history.deltas(args.price_history):
+            when = datetime.fromtimestamp(row["ts"], TEHRAN_TZ).strftime("%Y-%m-%d %H:%M")
+            change = f" ({row['delta']:+,})" if row["delta"] is not None else ""
+            print(f"{when} {row['category']} {row['model']} {row['brand']} | {row['variant']}: {format_toman(row['price'])}{change}")
+
+startup_timings["module"] = time.perf_counter() - MODULE_STARTED
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.check_window:
+        sys.exit(0 if within_run_window() else 1)
+    if args.movers or args.price_history:
+        print_price_report(args)
+        sys.exit()
+    if args.daemon:
+        run_daemon(args.interval)
+    elif not within_run_window():
+        print("🕒 خارج از بازه مجاز اجرا (۹:۳۰ تا ۲۳:۳۰). اسکریپت متوقف شد.")
+        sys.exit()
+    else:
+        main()
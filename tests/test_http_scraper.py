@@ -0,0 +1,89 @@
+import pytest
+
+import main
+
+VALID_BRANDS = ["Galaxy", "POCO", "Redmi", "iPhone", "Redtone", "VOCAL", "TCL", "NOKIA", "Honor", "Huawei", "GLX", "+Otel", "اینچی"]
+
+EXPECTED = {
+    "quick-checkout-mobile.html": [
+        ("A55 8/256 Galaxy", "مشکی", 25400000.0),
+        ("A55 8/256 Galaxy", "آبی روشن", 25600000.0),
+        ("Note 13 8/256 Redmi", "آبی", 12000000.0),
+        ("Note 13 8/256 Redmi", "سبز", 12100000.0),
+        ("Note 13 8/256 Redmi", "مشکی", 12200000.0),
+        ("Note 13 8/256 Redmi", "سفید", 12300000.0),
+        ("15 Pro Max LL 256GB iPhone", "طلایی", 89900000.0),
+        ("105 NOKIA", "مشکی", None),
+        ("105 NOKIA", "آبی", 1450000.0),
+    ],
+    "quick-checkout-console.html": [
+        ("کنسول بازی Play Station 5 Slim", "سفید", 41000000.0),
+    ],
+}
+
+def products_of(result):
+    brands, models, cards = result
+    return [(product.title, product.variant, product.raw_price) for product in main.build_products(brands, models, cards=cards)]
+
+@pytest.mark.parametrize("page", sorted(EXPECTED))
+def test_http_backend_extracts_every_card(fixture_server, page):
+    results = main.scrape_categories_http({"page": f"{fixture_server}/{page}"}, VALID_BRANDS)
+    assert products_of(results["page"]) == EXPECTED[page]
+
+def test_cards_with_flat_colour_rows_do_not_hide_other_cards(fixture_server):
+    brands, models, cards = main.scrape_categories_http({"mobile": f"{fixture_server}/quick-checkout-mobile.html"}, VALID_BRANDS)["mobile"]
+    assert len(set(cards)) == 4
+    assert "سامسونگ" not in models
+
+def test_partial_page_is_left_for_selenium(fixture_server):
+    # HTML سرور فقط دسته اول اسکرول بی‌پایان را دارد و JSON جاسازی‌شده تعداد کل را می‌گوید
+    results = main.scrape_categories_http({"mobile": f"{fixture_server}/quick-checkout-partial.html"}, VALID_BRANDS)
+    assert results["mobile"] is None
+
+def test_unknown_total_falls_back_to_known_card_count(fixture_server):
+    url = f"{fixture_server}/quick-checkout-mobile.html"
+    html = main.get_http_session().get(url).content.decode("utf-8")
+    stripped = main.NEXT_DATA_PATTERN.sub("", html)
+    assert main.embedded_item_total(stripped) is None
+    assert main.embedded_item_total(html) == 4
+    brands, models, cards = main.extract_product_data_from_html(stripped, VALID_BRANDS)
+    assert len(set(cards)) == 4
+
+def test_build_products_resets_pairing_at_card_boundaries():
+    # رنگی که قیمتش جا افتاده نباید قیمت کارت بعدی را بگیرد
+    brands = ["Galaxy", "", "", "", "Galaxy", "", ""]
+    models = ["A55 8/256", "مشکی", "25000000", "سفید", "A35", "آبی", "15000000"]
+    cards = [0, 0, 0, 0, 1, 1, 1]
+    products = main.build_products(brands, models, cards=cards)
+    assert [(p.title, p.variant, p.raw_price) for p in products] == [
+        ("A55 8/256 Galaxy", "مشکی", 25000000.0),
+        ("A55 8/256 Galaxy", "سفید", None),
+        ("A35 Galaxy", "آبی", 15000000.0),
+    ]
+
+def test_unknown_price_keeps_its_slot_in_the_pairing():
+    # «نامشخص» به متن خالی تبدیل می‌شود ولی رنگ بعدی نباید جای قیمت آن را بگیرد
+    texts = ["Galaxy A55 8/256", "مشکی", "نامشخص", "سفید", "25,500,000 تومان", "Galaxy A35", "آبی", "15,000,000 تومان"]
+    brands, models = main.parse_product_texts(texts, VALID_BRANDS)
+    products = main.build_products(brands, models)
+    assert [(p.title, p.variant, p.raw_price) for p in products] == [
+        ("A55 8/256 Galaxy", "مشکی", None),
+        ("A55 8/256 Galaxy", "سفید", 25500000.0),
+        ("A35 Galaxy", "آبی", 15000000.0),
+    ]
+    assert products[0].line() == "مشکی | "
+
+@pytest.fixture(scope="module")
+def driver():
+    driver = main.get_driver()
+    if driver is None:
+        pytest.skip("Chrome/chromedriver در دسترس نیست")
+    yield driver
+    driver.quit()
+
+@pytest.mark.parametrize("page", sorted(EXPECTED) + ["quick-checkout-partial.html"])
+def test_http_backend_matches_selenium(fixture_server, driver, page):
+    url = f"{fixture_server}/{page}"
+    selenium_result, _, _ = main.scrape_category(driver, url, VALID_BRANDS)
+    html = main.get_http_session().get(url).content.decode("utf-8")
+    assert main.extract_product_data_from_html(html, VALID_BRANDS) == tuple(selenium_result)
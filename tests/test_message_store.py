@@ -0,0 +1,36 @@
+import sqlite3
+
+import pytest
+
+import main
+
+def test_message_store_is_abstract():
+    with pytest.raises(TypeError):
+        main.MessageStore()
+
+def test_bookkeeping_stays_out_of_the_mirrored_rows(tmp_path):
+    store = main.SQLiteMessageStore(str(tmp_path / "state.db"))
+    store.replace("🔵", "1405-01-01", [["🔵", "1405-01-01", 1, 10, "a"]])
+    main.set_fingerprint(store, main.FINGERPRINT_KEY, "1405-01-01", "abc")
+    main.set_fingerprint(store, f"{main.CARDS_KEY} mobile", "1405-01-01", "12")
+    assert store.all_rows() == [["🔵", "1405-01-01", 1, 10, "a"]]
+    assert main.get_fingerprint(store, main.FINGERPRINT_KEY, "1405-01-01") == "abc"
+    assert main.expected_card_counts(store, "1405-01-01", ["mobile"]) == {"mobile": 12}
+    store.close()
+
+def test_bookkeeping_rows_of_an_old_database_are_moved(tmp_path):
+    path = str(tmp_path / "state.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE messages (emoji TEXT NOT NULL, date TEXT NOT NULL, part INTEGER NOT NULL, "
+                 "message_id INTEGER, text TEXT, PRIMARY KEY (emoji, date, part)) WITHOUT ROWID")
+    conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", [
+        ["🔵", "1405-01-01", 1, 10, "a"],
+        ["SOURCES 🔵", "1405-01-01", 1, "", "mobile"],
+    ])
+    conn.commit()
+    conn.close()
+    store = main.SQLiteMessageStore(path)
+    assert store.all_rows() == [["🔵", "1405-01-01", 1, 10, "a"]]
+    assert main.get_fingerprint(store, f"{main.SOURCES_KEY} 🔵", "1405-01-01") == "mobile"
+    assert store.dirty
+    store.close()
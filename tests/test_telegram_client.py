@@ -0,0 +1,74 @@
+import types
+
+import pytest
+import requests
+import urllib3
+
+import main
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    client = main.TelegramClient("token", rate_per_chat=1000, max_retries=3)
+    return client
+
+def fake_post(client, error=None, status=None):
+    calls = []
+
+    def post(url, json=None, timeout=None):
+        calls.append(url)
+        if error is not None:
+            raise error
+        return types.SimpleNamespace(status_code=status, ok=False, content=b"", request=None, text="")
+    client.session = types.SimpleNamespace(post=post)
+    return calls
+
+def post_count(client, method, error=None, status=None):
+    calls = fake_post(client, error, status)
+    client.call(method, {"chat_id": 1})
+    return len(calls)
+
+def connect_error():
+    reason = urllib3.exceptions.NewConnectionError(None, "connection refused")
+    return requests.ConnectionError(urllib3.exceptions.MaxRetryError(None, "/sendMessage", reason))
+
+def test_send_is_not_repeated_once_the_request_may_have_arrived(client):
+    assert post_count(client, "sendMessage", requests.ReadTimeout()) == 1
+    assert post_count(client, "sendMessage", requests.ConnectionError("Connection aborted")) == 1
+    assert post_count(client, "sendMessage", status=502) == 1
+
+def test_send_is_retried_when_the_connection_was_never_made(client):
+    assert post_count(client, "sendMessage", connect_error()) == 4
+
+def test_edit_and_delete_keep_the_full_backoff(client):
+    for method in ("editMessageText", "deleteMessage"):
+        assert post_count(client, method, requests.ReadTimeout()) == 4
+        assert post_count(client, method, status=502) == 4
+
+def test_send_that_may_have_arrived_is_marked_unknown(client):
+    fake_post(client, requests.ReadTimeout())
+    assert client.send_message(1, "x") == main.UNKNOWN_MESSAGE_ID
+    fake_post(client, status=502)
+    assert client.send_message(1, "x") == main.UNKNOWN_MESSAGE_ID
+    fake_post(client, connect_error())
+    assert client.send_message(1, "x") is None
+
+def test_unknown_send_is_not_resent_after_a_crash(tmp_path, monkeypatch):
+    journal = main.RunJournal(str(tmp_path / "journal.jsonl"))
+    journal.begin("1405-01-01")
+    op = journal.plan(1, "🔵", 1, "send", None, "a")
+    journal.finish(op, False, main.UNKNOWN_MESSAGE_ID)
+    journal.close()
+    state = journal.load()
+    assert state["operations"][0]["status"] == "unknown"
+
+    store = main.SQLiteMessageStore(str(tmp_path / "state.db"))
+    main.reconcile_journal(store, state, "1405-01-01")
+    sent = []
+    monkeypatch.setattr(main, "send_telegram_message", lambda *args: sent.append(args) or 7)
+    monkeypatch.setattr(main, "edit_telegram_message", lambda *args: sent.append(args) or True)
+    new_msgs, _ = main.edit_category_messages("🔵", [main.MessagePart("b")], "token", 1, store, "1405-01-01")
+    main.send_pending_messages(new_msgs, "token", 1, "🔵")
+    assert new_msgs[0][0] == main.UNKNOWN_MESSAGE_ID
+    assert sent == []
+    store.close()